@@ -1,18 +1,36 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, UploadFile, File, Form
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import io
 import os
+import asyncio
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, validator
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, validator, ValidationError
+from typing import List, Optional, Dict, Any, NamedTuple, Union
 import uuid
 from datetime import datetime, timezone, timedelta
 import httpx
 from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
+from PIL import Image, ImageOps
 import re
+import random
+import bisect
+import heapq
+import time
+import hmac
+import json
+import base64
+import hashlib
+import bcrypt
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -25,6 +43,121 @@ db = client[os.environ['DB_NAME']]
 # LLM Key
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
 
+# LLM calls: "emergent", or "fake" for a local provider with injected latency/faults
+LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'emergent')
+# Per-attempt timeout, overall deadline including retries, and retry backoff bounds
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', '30'))
+LLM_DEADLINE_SECONDS = float(os.environ.get('LLM_DEADLINE_SECONDS', '60'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '2'))
+LLM_RETRY_BASE_SECONDS = float(os.environ.get('LLM_RETRY_BASE_SECONDS', '0.5'))
+LLM_RETRY_MAX_SECONDS = float(os.environ.get('LLM_RETRY_MAX_SECONDS', '4'))
+# Circuit breaker per model: open after this many failed calls, probe again after the reset
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('LLM_BREAKER_FAILURE_THRESHOLD', '5'))
+LLM_BREAKER_RESET_SECONDS = float(os.environ.get('LLM_BREAKER_RESET_SECONDS', '30'))
+# Admission control over all LLM calls of this process: concurrent calls, waiting
+# calls, and the longest a call may wait for a slot before it is shed with a 503
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '16'))
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', '64'))
+LLM_ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get('LLM_ADMISSION_MAX_WAIT_SECONDS', '10'))
+# Send a duplicate request when an attempt is slower than this (0 disables hedging)
+LLM_HEDGE_AFTER_SECONDS = float(os.environ.get('LLM_HEDGE_AFTER_SECONDS', '0'))
+# Fake provider behaviour (LLM_PROVIDER=fake)
+FAKE_LLM_LATENCY_SECONDS = float(os.environ.get('FAKE_LLM_LATENCY_SECONDS', '0.5'))
+FAKE_LLM_JITTER_SECONDS = float(os.environ.get('FAKE_LLM_JITTER_SECONDS', '0'))
+FAKE_LLM_FAILURE_RATE = float(os.environ.get('FAKE_LLM_FAILURE_RATE', '0'))
+FAKE_LLM_HANG_RATE = float(os.environ.get('FAKE_LLM_HANG_RATE', '0'))
+
+# Shared secret for GET /api/system/metrics (X-Metrics-Token header); unset hides the endpoint
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Session cache (in-process, per worker)
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL_SECONDS = float(os.environ.get('SESSION_CACHE_TTL_SECONDS', '60'))
+# How a cache miss resolves session + user: "two_query", "lookup" ($lookup aggregation)
+# or "snapshot" (user copy embedded in the session document)
+SESSION_RESOLUTION_MODE = os.environ.get('SESSION_RESOLUTION_MODE', 'snapshot')
+# Sliding renewal: extend a session at most once per interval while it is in use
+SESSION_RENEW_INTERVAL_SECONDS = float(os.environ.get('SESSION_RENEW_INTERVAL_SECONDS', '3600'))
+
+# Token format for new email/guest sessions: "opaque" (sess_...) or "signed" (st1...,
+# HMAC-signed, verified in-process). Opaque tokens stay valid in both modes.
+SESSION_TOKEN_FORMAT = os.environ.get('SESSION_TOKEN_FORMAT', 'opaque')
+SESSION_SIGNING_KEY = os.environ.get('SESSION_SIGNING_KEY', '')
+REVOCATION_SYNC_INTERVAL_SECONDS = float(os.environ.get('REVOCATION_SYNC_INTERVAL_SECONDS', '5'))
+
+# Guest reaper: deletes guest accounts that no longer have a live session
+GUEST_RETENTION_DAYS = float(os.environ.get('GUEST_RETENTION_DAYS', '7'))
+GUEST_REAPER_INTERVAL_SECONDS = float(os.environ.get('GUEST_REAPER_INTERVAL_SECONDS', '3600'))
+GUEST_REAPER_BATCH_SIZE = int(os.environ.get('GUEST_REAPER_BATCH_SIZE', '200'))
+GUEST_REAPER_BATCH_PAUSE_SECONDS = float(os.environ.get('GUEST_REAPER_BATCH_PAUSE_SECONDS', '1'))
+
+# Password hashing: bcrypt work factor and size of the hashing thread pool
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '4'))
+
+# Vision result cache (in-process, per worker)
+VISION_CACHE_MAX_ENTRIES = int(os.environ.get('VISION_CACHE_MAX_ENTRIES', '2000'))
+VISION_CACHE_TTL_SECONDS = float(os.environ.get('VISION_CACHE_TTL_SECONDS', '86400'))
+VISION_CACHE_MAX_BYTES = int(os.environ.get('VISION_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# Shared vision_results collection, expires via TTL index
+VISION_RESULT_TTL_DAYS = float(os.environ.get('VISION_RESULT_TTL_DAYS', '30'))
+# Near-duplicate photos: max Hamming distance (of 64 bits) between dHashes to reuse a result
+VISION_PHASH_MAX_DISTANCE = int(os.environ.get('VISION_PHASH_MAX_DISTANCE', '6'))
+VISION_PHASH_SYNC_SECONDS = float(os.environ.get('VISION_PHASH_SYNC_SECONDS', '60'))
+# Hashes held per worker (oldest dropped first) and how often the index is rebuilt from
+# unexpired vision_results, which drops hashes whose results the TTL index removed
+VISION_PHASH_MAX_ENTRIES = int(os.environ.get('VISION_PHASH_MAX_ENTRIES', '200000'))
+VISION_PHASH_REBUILD_SECONDS = float(os.environ.get('VISION_PHASH_REBUILD_SECONDS', '3600'))
+# Fallback poll interval for food index updates when change streams are unavailable
+FOOD_INDEX_REFRESH_SECONDS = float(os.environ.get('FOOD_INDEX_REFRESH_SECONDS', '300'))
+# Fuzzy food matching: minimum trigram similarity to accept, candidates scored per lookup
+# and how many trigram postings are scanned to find them
+FOOD_MATCH_MIN_SCORE = float(os.environ.get('FOOD_MATCH_MIN_SCORE', '0.4'))
+FOOD_FUZZY_CANDIDATES = int(os.environ.get('FOOD_FUZZY_CANDIDATES', '50'))
+FOOD_FUZZY_POSTINGS_BUDGET = int(os.environ.get('FOOD_FUZZY_POSTINGS_BUDGET', '5000'))
+# Threads for image decoding/hashing work
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '2'))
+# Multi-photo meals: images per batch request and how many are analyzed at once
+VISION_BATCH_MAX_IMAGES = int(os.environ.get('VISION_BATCH_MAX_IMAGES', '6'))
+VISION_BATCH_CONCURRENCY = int(os.environ.get('VISION_BATCH_CONCURRENCY', '3'))
+# Asynchronous vision jobs: worker slots per process, lease per attempt (renewed every
+# third of it while the job runs, so it only bounds how long a crashed worker holds a job),
+# retention
+VISION_JOB_WORKERS = int(os.environ.get('VISION_JOB_WORKERS', '4'))
+VISION_JOB_LEASE_SECONDS = float(os.environ.get('VISION_JOB_LEASE_SECONDS', '180'))
+VISION_JOB_MAX_ATTEMPTS = int(os.environ.get('VISION_JOB_MAX_ATTEMPTS', '3'))
+VISION_JOB_POLL_SECONDS = float(os.environ.get('VISION_JOB_POLL_SECONDS', '1'))
+VISION_JOB_MAX_WAIT_SECONDS = float(os.environ.get('VISION_JOB_MAX_WAIT_SECONDS', '25'))
+VISION_JOB_TTL_HOURS = float(os.environ.get('VISION_JOB_TTL_HOURS', '24'))
+# Vision model cascade: the fast tier answers first, the strong tier re-analyzes when an
+# item's confidence is below the threshold, the model asks for confirmation or its
+# output did not parse. Escalations per UTC day are capped per user and globally.
+VISION_FAST_MODEL = os.environ.get('VISION_FAST_MODEL', 'gpt-4o-mini')
+VISION_STRONG_MODEL = os.environ.get('VISION_STRONG_MODEL', 'gpt-4o')
+VISION_ESCALATION_CONFIDENCE = float(os.environ.get('VISION_ESCALATION_CONFIDENCE', '0.6'))
+VISION_ESCALATION_USER_DAILY_BUDGET = int(os.environ.get('VISION_ESCALATION_USER_DAILY_BUDGET', '10'))
+VISION_ESCALATION_GLOBAL_DAILY_BUDGET = int(os.environ.get('VISION_ESCALATION_GLOBAL_DAILY_BUDGET', '2000'))
+# Estimated cost of one image analysis per tier (USD), for the cost metrics
+VISION_FAST_COST_USD = float(os.environ.get('VISION_FAST_COST_USD', '0.0004'))
+VISION_STRONG_COST_USD = float(os.environ.get('VISION_STRONG_COST_USD', '0.006'))
+# Images are downscaled to this longest side and re-encoded before any LLM call
+VISION_MAX_DIMENSION = int(os.environ.get('VISION_MAX_DIMENSION', '1024'))
+VISION_JPEG_QUALITY = int(os.environ.get('VISION_JPEG_QUALITY', '85'))
+# Largest image accepted by the multipart upload endpoints
+MAX_IMAGE_UPLOAD_BYTES = int(os.environ.get('MAX_IMAGE_UPLOAD_BYTES', str(10 * 1024 * 1024)))
+# Room for form fields / JSON around the image(s) in a request body
+REQUEST_BODY_OVERHEAD_BYTES = 64 * 1024
+
+# Emergent OAuth session exchange (shared pooled HTTP client)
+EMERGENT_AUTH_URL = os.environ.get(
+    'EMERGENT_AUTH_URL',
+    'https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data'
+)
+AUTH_HTTP_CONNECT_TIMEOUT = float(os.environ.get('AUTH_HTTP_CONNECT_TIMEOUT', '5'))
+AUTH_HTTP_READ_TIMEOUT = float(os.environ.get('AUTH_HTTP_READ_TIMEOUT', '10'))
+AUTH_HTTP_RETRIES = int(os.environ.get('AUTH_HTTP_RETRIES', '2'))
+AUTH_HTTP_MAX_CONNECTIONS = int(os.environ.get('AUTH_HTTP_MAX_CONNECTIONS', '50'))
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -102,6 +235,8 @@ class DetectedFoodItem(BaseModel):
     portion: PortionEstimate
     confidence: float
     food_id: Optional[str] = None  # Mapped from DB
+    match_type: Optional[str] = None  # exact | partial | fuzzy, None when estimated
+    match_score: Optional[float] = None  # name similarity of the DB match, 0-1
     calories: Optional[int] = None
     protein: Optional[float] = None
     carbs: Optional[float] = None
@@ -119,6 +254,39 @@ class VisionAnalyzeResponse(BaseModel):
     total_protein: float = 0
     total_carbs: float = 0
     total_fat: float = 0
+    model_tier: Optional[str] = None  # fast | strong, which model produced the detections
+
+class VisionBatchRequest(BaseModel):
+    images_base64: List[str]
+    locale: str = "tr-TR"
+
+class VisionBatchImageResult(BaseModel):
+    index: int  # position in the request
+    status: str  # ok | error
+    result: Optional[VisionAnalyzeResponse] = None
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+
+class VisionBatchResponse(BaseModel):
+    results: List[VisionBatchImageResult]
+    # Whole meal: a dish seen in several photos is counted once
+    items: List[DetectedFoodItem]
+    notes: List[str] = []
+    needs_user_confirmation: bool = False
+    total_calories: int = 0
+    total_protein: float = 0
+    total_carbs: float = 0
+    total_fat: float = 0
+    failed: int = 0
+
+class VisionJobResponse(BaseModel):
+    job_id: str
+    status: str  # queued | running | done | failed
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    result: Optional[VisionAnalyzeResponse] = None
+    error: Optional[str] = None
 
 class AddMealRequest(BaseModel):
     name: str
@@ -253,15 +421,45 @@ class LoginRequest(BaseModel):
 
 # ==================== HELPER FUNCTIONS ====================
 
-import hashlib
+# bcrypt is CPU bound for ~100ms+, so it never runs on the event loop
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password")
 
-def hash_password(password: str) -> str:
-    """Simple password hashing"""
+def bcrypt_hash(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=rounds)).decode()
+
+def bcrypt_verify(password: str, hashed: str) -> bool:
+    try:
+        return bcrypt.checkpw(password.encode(), hashed.encode())
+    except ValueError:
+        return False
+
+def bcrypt_rounds(hashed: str) -> Optional[int]:
+    """Work factor of a "$2b$12$..." hash, None for anything that is not bcrypt"""
+    parts = hashed.split("$")
+    if len(parts) >= 4 and parts[1] in ("2a", "2b", "2y") and parts[2].isdigit():
+        return int(parts[2])
+    return None
+
+def legacy_password_hash(password: str) -> str:
+    """Unsalted SHA-256 used before bcrypt, only for verifying old accounts"""
     return hashlib.sha256(password.encode()).hexdigest()
 
-def verify_password(password: str, hashed: str) -> bool:
-    """Verify password against hash"""
-    return hash_password(password) == hashed
+async def hash_password(password: str) -> str:
+    """Hash password with bcrypt in the password thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, bcrypt_hash, password, BCRYPT_ROUNDS)
+
+async def verify_password(password: str, hashed: str) -> tuple:
+    """Verify password against hash, returns (matches, needs_rehash)"""
+    rounds = bcrypt_rounds(hashed)
+    
+    if rounds is None:
+        matches = bool(hashed) and hmac.compare_digest(legacy_password_hash(password), hashed)
+        return matches, matches
+    
+    loop = asyncio.get_running_loop()
+    matches = await loop.run_in_executor(password_executor, bcrypt_verify, password, hashed)
+    return matches, matches and rounds < BCRYPT_ROUNDS
 
 def calculate_calorie_goal(height: float, weight: float, age: int, gender: str, activity_level: str) -> int:
     """Calculate daily calorie goal using Harris-Benedict formula"""
@@ -283,8 +481,525 @@ def calculate_calorie_goal(height: float, weight: float, age: int, gender: str,
     factor = activity_factors.get(activity_level, 1.2)
     return int(bmr * factor)
 
-async def get_current_user(request: Request) -> Optional[User]:
-    """Get current user from session token"""
+class BoundedTTLCache:
+    """In-process LRU cache with a per-entry TTL, optional byte budget and hit/miss counters"""
+    
+    def __init__(self, max_entries: int, ttl_seconds: float, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at_monotonic, value, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None, size: int = 0):
+        ttl = self.ttl_seconds if ttl_seconds is None else min(ttl_seconds, self.ttl_seconds)
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, value, size)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self.bytes > self.max_bytes
+        ):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+    
+    def pop(self, key: str) -> Optional[Any]:
+        entry = self._remove(key)
+        return entry[1] if entry else None
+    
+    def pop_where(self, predicate) -> int:
+        """Drop every entry whose value matches predicate, returns how many were dropped"""
+        keys = [key for key, (_, value, _) in self._entries.items() if predicate(value)]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+    
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+    
+    def _remove(self, key: str) -> Optional[tuple]:
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.bytes -= entry[2]
+        return entry
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+class CachedSession(NamedTuple):
+    user: User
+    expires_at: Optional[datetime]
+    lifetime: Optional[timedelta]  # original length, reused for sliding renewal
+
+class LatencyRecorder:
+    """Rolling window of durations with percentile snapshots"""
+    
+    def __init__(self, window: int = 1000):
+        self.samples: deque = deque(maxlen=window)
+        self.count = 0
+        self.errors = 0
+    
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+    
+    def record_error(self):
+        self.errors += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        ordered = sorted(self.samples)
+        
+        def percentile(p: float) -> Optional[float]:
+            if not ordered:
+                return None
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 2)
+        
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(ordered[-1] * 1000, 2) if ordered else None,
+        }
+
+class CircuitBreaker:
+    """Fail fast after consecutive failures; let one probe through after a cool-down"""
+    
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.trips = 0
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+    
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+    
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.probing:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+            self.probing = False
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self.failures, "trips": self.trips}
+
+class AdmissionController:
+    """Process-wide cap on concurrent calls with a bounded priority wait queue.
+    
+    Lower priority values are served first. A caller whose estimated wait exceeds
+    max_wait is shed at once (503) rather than queued; a full queue rejects (429)
+    unless the newcomer outranks a queued caller, which is then rejected instead.
+    """
+    
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self._queue: List[list] = []  # heap of [priority, seq, future]
+        self._seq = 0
+        self.service_time = 1.0  # moving average of slot hold time, seconds
+        self.wait_latency = LatencyRecorder()
+        self.counters: Dict[str, int] = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_queue_full": 0,
+            "shed_deadline": 0,
+            "evicted": 0,
+        }
+    
+    def estimated_wait(self, ahead: int) -> float:
+        return (ahead // self.limit + 1) * self.service_time
+    
+    def rejection(self, status_code: int, retry_after: float) -> HTTPException:
+        detail = "Çok fazla istek, lütfen biraz sonra tekrar deneyin" if status_code == 429 \
+            else "Sunucu yoğun, lütfen biraz sonra tekrar deneyin"
+        return HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(max(1, int(retry_after + 0.5)))}
+        )
+    
+    def _handed_over(self, entry: list) -> bool:
+        future = entry[2]
+        return future.done() and not future.cancelled() and future.exception() is None
+    
+    def _remove(self, entry: list):
+        if entry in self._queue:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+    
+    async def acquire(self, priority: int, max_wait: float):
+        if self.active < self.limit and not self._queue:
+            self.active += 1
+            self.counters["admitted"] += 1
+            self.wait_latency.record(0.0)
+            return
+        
+        wait = self.estimated_wait(sum(1 for entry in self._queue if entry[0] <= priority))
+        if wait > max_wait:
+            self.counters["shed_deadline"] += 1
+            raise self.rejection(503, wait)
+        if len(self._queue) >= self.max_queue:
+            worst = max(self._queue, key=lambda entry: (entry[0], entry[1]))
+            if worst[0] <= priority:
+                self.counters["rejected_queue_full"] += 1
+                raise self.rejection(429, wait)
+            self._remove(worst)
+            self.counters["evicted"] += 1
+            worst[2].set_exception(self.rejection(429, wait))
+        
+        loop = asyncio.get_running_loop()
+        self._seq += 1
+        entry = [priority, self._seq, loop.create_future()]
+        heapq.heappush(self._queue, entry)
+        self.counters["queued"] += 1
+        started = loop.time()
+        try:
+            await asyncio.wait_for(entry[2], max_wait)
+        except asyncio.TimeoutError:
+            if self._handed_over(entry):
+                self.release(0.0)  # the slot was handed over just as we timed out
+            self._remove(entry)
+            self.counters["shed_deadline"] += 1
+            raise self.rejection(503, self.service_time)
+        except asyncio.CancelledError:
+            if self._handed_over(entry):
+                self.release(0.0)  # the slot was handed over just as we were cancelled
+            self._remove(entry)
+            raise
+        self.counters["admitted"] += 1
+        self.wait_latency.record(loop.time() - started)
+    
+    def release(self, held_seconds: float):
+        self.service_time = 0.8 * self.service_time + 0.2 * held_seconds
+        while self._queue:
+            # Hand the slot straight to the next live waiter
+            entry = heapq.heappop(self._queue)
+            if not entry[2].done():
+                entry[2].set_result(None)
+                return
+        self.active -= 1
+    
+    @asynccontextmanager
+    async def slot(self, priority: int, max_wait: float):
+        await self.acquire(priority, max_wait)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "active": self.active,
+            "limit": self.limit,
+            "queue_depth": len(self._queue),
+            "max_queue": self.max_queue,
+            "avg_service_seconds": round(self.service_time, 3),
+            "queue_wait": self.wait_latency.stats(),
+        }
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key onto one in-flight task"""
+    
+    def __init__(self):
+        self._flights: Dict[str, list] = {}  # key -> [task, waiter count]
+        self.calls = 0
+        self.coalesced = 0
+    
+    async def do(self, key: str, factory):
+        """Await factory() once per key; concurrent callers share its result or error"""
+        self.calls += 1
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = [asyncio.ensure_future(factory()), 0]
+            self._flights[key] = flight
+            flight[0].add_done_callback(lambda task: self._finish(key, flight))
+        else:
+            self.coalesced += 1
+        
+        flight[1] += 1
+        try:
+            # shield: a caller that goes away must not cancel the others' work
+            return await asyncio.shield(flight[0])
+        except asyncio.CancelledError:
+            if flight[1] == 1 and not flight[0].done():
+                # Last waiter left, nobody needs the result any more
+                self._forget(key, flight)
+                flight[0].cancel()
+            raise
+        finally:
+            flight[1] -= 1
+    
+    def _forget(self, key: str, flight: list):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+    
+    def _finish(self, key: str, flight: list):
+        self._forget(key, flight)
+        task = flight[0]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every waiter was cancelled
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._flights),
+        }
+
+# session_token -> CachedSession. Entries never outlive the session itself; every write to a
+# user document must call sync_user_sessions() so this worker stops serving the
+# old User. Other workers converge within SESSION_CACHE_TTL_SECONDS.
+session_cache = BoundedTTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL_SECONDS)
+
+# Fields never copied into session snapshots
+SNAPSHOT_EXCLUDED_FIELDS = {"_id", "password_hash"}
+
+def user_snapshot(user_doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of a user document that is safe to embed in user_sessions"""
+    return {k: v for k, v in user_doc.items() if k not in SNAPSHOT_EXCLUDED_FIELDS}
+
+SIGNED_TOKEN_PREFIX = "st1."
+
+# jti -> expiry (unix seconds) of logged-out signed tokens, synced from revoked_tokens
+revoked_token_ids: Dict[str, float] = {}
+revocations_synced_at: Optional[datetime] = None
+
+def b64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def b64url_decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def sign_token_payload(payload: str) -> str:
+    digest = hmac.new(SESSION_SIGNING_KEY.encode(), (SIGNED_TOKEN_PREFIX + payload).encode(), hashlib.sha256).digest()
+    return b64url_encode(digest)
+
+def issue_signed_token(user_id: str, expires_at: datetime) -> str:
+    """st1.<payload>.<signature> carrying user id, expiry and a revocation id"""
+    payload = b64url_encode(json.dumps(
+        {"uid": user_id, "exp": int(expires_at.timestamp()), "jti": uuid.uuid4().hex},
+        separators=(",", ":")
+    ).encode())
+    return f"{SIGNED_TOKEN_PREFIX}{payload}.{sign_token_payload(payload)}"
+
+def verify_signed_token(token: str) -> Optional[Dict[str, Any]]:
+    """Claims of a valid, unexpired and unrevoked signed token, else None"""
+    if not SESSION_SIGNING_KEY:
+        return None
+    try:
+        payload, signature = token[len(SIGNED_TOKEN_PREFIX):].split(".")
+        if not hmac.compare_digest(signature, sign_token_payload(payload)):
+            return None
+        claims = json.loads(b64url_decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict):
+        return None
+    
+    if claims.get("exp", 0) < time.time() or claims.get("jti") in revoked_token_ids:
+        return None
+    return claims
+
+async def revoke_signed_token(claims: Dict[str, Any]):
+    """Reject a signed token on this worker now and on the others after their next sync"""
+    revoked_token_ids[claims["jti"]] = claims["exp"]
+    await db.revoked_tokens.update_one(
+        {"jti": claims["jti"]},
+        {"$set": {
+            "expires_at": datetime.fromtimestamp(claims["exp"], timezone.utc),
+            "revoked_at": datetime.now(timezone.utc)
+        }},
+        upsert=True
+    )
+
+async def sync_revoked_tokens():
+    """Pull revocations written by other workers since the last sync"""
+    global revocations_synced_at
+    now = datetime.now(timezone.utc)
+    query = {"expires_at": {"$gt": now}}
+    if revocations_synced_at:
+        # Overlap absorbs clock skew between workers
+        query["revoked_at"] = {"$gte": revocations_synced_at - timedelta(seconds=30)}
+    
+    async for doc in db.revoked_tokens.find(query, {"_id": 0, "jti": 1, "expires_at": 1}):
+        revoked_token_ids[doc["jti"]] = doc["expires_at"].replace(tzinfo=timezone.utc).timestamp()
+    revocations_synced_at = now
+    
+    # Expired tokens fail verification anyway
+    cutoff = time.time()
+    for jti in [jti for jti, exp in revoked_token_ids.items() if exp < cutoff]:
+        del revoked_token_ids[jti]
+
+async def create_session(
+    user_doc: Dict[str, Any],
+    lifetime: timedelta,
+    session_token: Optional[str] = None
+) -> str:
+    """Store a session for user_doc with an embedded user snapshot, returns the token.
+    
+    Upserted on session_token: exchanging the same upstream token again refreshes
+    the existing session instead of colliding with session_token_unique."""
+    now = datetime.now(timezone.utc)
+    if not session_token:
+        if SESSION_TOKEN_FORMAT == "signed" and SESSION_SIGNING_KEY:
+            session_token = issue_signed_token(user_doc["user_id"], now + lifetime)
+        else:
+            session_token = f"sess_{uuid.uuid4().hex}"
+    for attempt in range(2):
+        try:
+            await db.user_sessions.update_one(
+                {"session_token": session_token},
+                {
+                    "$set": {
+                        "user_id": user_doc["user_id"],
+                        "expires_at": now + lifetime,
+                        "user": user_snapshot(user_doc)
+                    },
+                    "$setOnInsert": {"created_at": now}
+                },
+                upsert=True
+            )
+            break
+        except DuplicateKeyError:
+            # Two concurrent first exchanges of one token: the retry updates the winner's session
+            if attempt:
+                raise
+    session_cache.pop(session_token)
+    return session_token
+
+async def sync_user_sessions(user_id: str, user_doc: Optional[Dict[str, Any]] = None):
+    """Propagate a users write: drop cached Users and refresh session snapshots"""
+    session_cache.pop_where(lambda entry: entry.user.user_id == user_id)
+    
+    if user_doc is None:
+        user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
+        if not user_doc:
+            return
+    
+    await db.user_sessions.update_many(
+        {"user_id": user_id},
+        {"$set": {"user": user_snapshot(user_doc)}}
+    )
+
+async def resolve_session(session_token: str, mode: Optional[str] = None) -> tuple:
+    """Load (session, user_doc) for a token using the configured resolution mode"""
+    mode = mode or SESSION_RESOLUTION_MODE
+    
+    if mode == "lookup":
+        # One round trip: join users into the session server-side
+        docs = await db.user_sessions.aggregate([
+            {"$match": {"session_token": session_token}},
+            {"$limit": 1},
+            {"$lookup": {
+                "from": "users",
+                "localField": "user_id",
+                "foreignField": "user_id",
+                "as": "joined_user"
+            }},
+            {"$project": {"_id": 0, "user": 0, "joined_user._id": 0}}
+        ]).to_list(1)
+        if not docs:
+            return None, None
+        session = docs[0]
+        joined = session.pop("joined_user", [])
+        return session, (joined[0] if joined else None)
+    
+    session = await db.user_sessions.find_one(
+        {"session_token": session_token},
+        {"_id": 0}
+    )
+    
+    if not session:
+        return None, None
+    
+    snapshot = session.pop("user", None)
+    if mode == "snapshot" and snapshot:
+        return session, snapshot
+    
+    user_doc = await db.users.find_one(
+        {"user_id": session["user_id"]},
+        {"_id": 0}
+    )
+    
+    # Backfill sessions created before snapshots existed
+    if mode == "snapshot" and user_doc:
+        await db.user_sessions.update_one(
+            {"session_token": session_token},
+            {"$set": {"user": user_snapshot(user_doc)}}
+        )
+    
+    return session, user_doc
+
+def get_session_token(request: Request) -> Optional[str]:
+    """Read session token from cookie or Authorization header"""
     # Try to get token from cookie first
     session_token = request.cookies.get("session_token")
     
@@ -294,19 +1009,58 @@ async def get_current_user(request: Request) -> Optional[User]:
         if auth_header and auth_header.startswith("Bearer "):
             session_token = auth_header.split(" ")[1]
     
+    return session_token or None
+
+async def get_current_user(request: Request) -> Optional[User]:
+    """Get current user from session token"""
+    session_token = get_session_token(request)
+    
     if not session_token:
         return None
     
-    # Find session
-    session = await db.user_sessions.find_one(
-        {"session_token": session_token},
-        {"_id": 0}
-    )
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return await get_signed_session_user(session_token)
+    
+    cached = session_cache.get(session_token)
+    if cached is None:
+        cached = await load_session(session_token)
+        if cached is None:
+            return None
+    elif cached.expires_at and cached.expires_at < datetime.now(timezone.utc):
+        session_cache.pop(session_token)
+        return None
+    
+    await renew_session(session_token, cached)
+    
+    return cached.user
+
+async def get_signed_session_user(session_token: str) -> Optional[User]:
+    """Signed tokens are verified in-process; only a cold cache reads users"""
+    claims = verify_signed_token(session_token)
+    if claims is None:
+        session_cache.pop(session_token)
+        return None
+    
+    cached = session_cache.get(session_token)
+    if cached is None:
+        user_doc = await db.users.find_one({"user_id": claims["uid"]}, {"_id": 0})
+        if not user_doc:
+            return None
+        expires_at = datetime.fromtimestamp(claims["exp"], timezone.utc)
+        # Signed tokens carry a fixed expiry, so no sliding renewal
+        cached = CachedSession(user=User(**user_doc), expires_at=expires_at, lifetime=None)
+        session_cache.set(session_token, cached, ttl_seconds=claims["exp"] - time.time())
+    
+    return cached.user
+
+async def load_session(session_token: str) -> Optional[CachedSession]:
+    """Resolve a token from the database and cache the result"""
+    session, user_doc = await resolve_session(session_token)
     
     if not session:
         return None
     
-    # Check if session is expired
+    # Check if session is expired (the TTL index removes it shortly after)
     expires_at = session.get("expires_at")
     if expires_at:
         if expires_at.tzinfo is None:
@@ -314,107 +1068,654 @@ async def get_current_user(request: Request) -> Optional[User]:
         if expires_at < datetime.now(timezone.utc):
             return None
     
-    # Get user
-    user_doc = await db.users.find_one(
-        {"user_id": session["user_id"]},
-        {"_id": 0}
-    )
-    
     if not user_doc:
         return None
     
-    return User(**user_doc)
-
-# ==================== AUTH ENDPOINTS ====================
+    created_at = session.get("created_at")
+    lifetime = None
+    if expires_at and created_at:
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        lifetime = expires_at - created_at
+    
+    cached = CachedSession(user=User(**user_doc), expires_at=expires_at, lifetime=lifetime)
+    
+    # Cache until the session expires (capped by the cache TTL)
+    session_ttl = (expires_at - datetime.now(timezone.utc)).total_seconds() if expires_at else None
+    session_cache.set(session_token, cached, ttl_seconds=session_ttl)
+    
+    return cached
 
-@api_router.post("/auth/session", response_model=SessionDataResponse)
-async def exchange_session(request: Request):
-    """Exchange session_id for session_token"""
-    session_id = request.headers.get("X-Session-ID")
+async def renew_session(session_token: str, cached: CachedSession):
+    """Slide expires_at forward, writing at most once per SESSION_RENEW_INTERVAL_SECONDS"""
+    if not cached.expires_at or not cached.lifetime:
+        return
     
-    if not session_id:
-        raise HTTPException(status_code=400, detail="X-Session-ID header required")
+    now = datetime.now(timezone.utc)
+    elapsed = cached.lifetime - (cached.expires_at - now)
+    if elapsed.total_seconds() < SESSION_RENEW_INTERVAL_SECONDS:
+        return
     
-    # Call Emergent Auth API
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-                headers={"X-Session-ID": session_id}
+    new_expires_at = now + cached.lifetime
+    # Update the cache first so concurrent requests on this worker skip the write
+    session_cache.set(
+        session_token,
+        cached._replace(expires_at=new_expires_at),
+        ttl_seconds=cached.lifetime.total_seconds()
+    )
+    # Conditional on the old value so only one worker renews per interval
+    await db.user_sessions.update_one(
+        {"session_token": session_token, "expires_at": cached.expires_at},
+        {"$set": {"expires_at": new_expires_at}}
+    )
+
+# ==================== HTTP CLIENT ====================
+
+# Application-scoped client: created at startup, closed at shutdown
+http_client: Optional[httpx.AsyncClient] = None
+
+# Upstream statuses worth retrying; the session-data GET is idempotent
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+
+auth_exchange_latency = LatencyRecorder()
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(AUTH_HTTP_READ_TIMEOUT, connect=AUTH_HTTP_CONNECT_TIMEOUT),
+        # No transport-level retries: fetch_oauth_session_data is the only retry layer
+        transport=httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=AUTH_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=AUTH_HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=30
             )
-            response.raise_for_status()
-            user_data = response.json()
-        except Exception as e:
-            logger.error(f"Error exchanging session: {e}")
-            raise HTTPException(status_code=400, detail="Invalid session ID")
-    
-    # Check if user exists
-    existing_user = await db.users.find_one(
-        {"email": user_data["email"]},
-        {"_id": 0}
+        )
     )
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = create_http_client()
+    return http_client
+
+async def fetch_oauth_session_data(session_id: str) -> Dict[str, Any]:
+    """Exchange an Emergent session_id for user data, retrying transient failures"""
+    started = time.monotonic()
+    try:
+        for attempt in range(AUTH_HTTP_RETRIES + 1):
+            last_attempt = attempt == AUTH_HTTP_RETRIES
+            try:
+                response = await get_http_client().get(
+                    EMERGENT_AUTH_URL,
+                    headers={"X-Session-ID": session_id}
+                )
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES or last_attempt:
+                    response.raise_for_status()
+                    user_data = response.json()
+                    auth_exchange_latency.record(time.monotonic() - started)
+                    return user_data
+            await asyncio.sleep(0.2 * (2 ** attempt))
+    except Exception:
+        auth_exchange_latency.record_error()
+        raise
+
+# ==================== LLM CLIENT ====================
+
+class LlmTransientError(Exception):
+    """Provider failure worth retrying (timeouts, rate limits, 5xx)"""
+
+class EmergentLlmProvider:
+    """Vision/chat calls through emergentintegrations.
     
-    if existing_user:
-        user_id = existing_user["user_id"]
-    else:
-        # Create new user
-        user_id = f"user_{uuid.uuid4().hex[:12]}"
-        await db.users.insert_one({
-            "user_id": user_id,
-            "email": user_data["email"],
-            "name": user_data["name"],
-            "picture": user_data.get("picture"),
-            "created_at": datetime.now(timezone.utc),
-            "water_goal": 2500,
-            "step_goal": 10000
-        })
+    LlmChat keeps the conversation on the instance, so each call gets a fresh one
+    with its own session_id: stateless requests never carry earlier history, and
+    concurrent calls never share an instance.
+    """
     
-    # Create session
-    session_token = user_data["session_token"]
-    await db.user_sessions.insert_one({
-        "user_id": user_id,
-        "session_token": session_token,
-        "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
-        "created_at": datetime.now(timezone.utc)
-    })
+    async def send(self, model: tuple, system_message: str, text: str, image_base64: Optional[str] = None) -> str:
+        chat = LlmChat(
+            api_key=EMERGENT_LLM_KEY,
+            session_id=f"llm_{uuid.uuid4().hex}",
+            system_message=system_message
+        ).with_model(*model)
+        file_contents = [ImageContent(image_base64=image_base64)] if image_base64 else None
+        return await chat.send_message(UserMessage(text=text, file_contents=file_contents))
     
-    # Create response
-    response = JSONResponse(content={
-        "user_id": user_id,
-        "email": user_data["email"],
-        "name": user_data["name"],
-        "picture": user_data.get("picture"),
-        "session_token": session_token
-    })
+    async def stream(self, model: tuple, system_message: str, text: str, image_base64: Optional[str] = None):
+        # emergentintegrations has no streaming call, the reply arrives as one chunk
+        yield await self.send(model, system_message, text, image_base64)
+
+class FakeLlmProvider:
+    """Local stand-in for load and fault testing: configurable latency, errors and hangs.
     
-    # Set cookie
-    response.set_cookie(
-        key="session_token",
-        value=session_token,
-        httponly=True,
-        secure=True,
-        samesite="none",
-        max_age=7 * 24 * 60 * 60,
-        path="/"
-    )
+    The canned reply carries both the vision and the legacy analyze fields so
+    either parser accepts it.
+    """
     
-    return response
+    def __init__(self):
+        self.latency = FAKE_LLM_LATENCY_SECONDS
+        self.jitter = FAKE_LLM_JITTER_SECONDS
+        self.failure_rate = FAKE_LLM_FAILURE_RATE
+        self.hang_rate = FAKE_LLM_HANG_RATE
+        self.calls = 0
+        self.response_text = json.dumps({
+            "items": [{
+                "label": "Mercimek Çorbası",
+                "aliases": ["lentil soup"],
+                "portion": {"estimate_g": 250, "range_g": [200, 300], "basis": "visual_estimate"},
+                "confidence": 0.9
+            }],
+            "notes": [],
+            "needs_user_confirmation": False,
+            "calories": 180,
+            "protein": 9.0,
+            "carbs": 27.0,
+            "fat": 4.0,
+            "description": "Mercimek çorbası"
+        }, ensure_ascii=False)
+    
+    async def send(self, model: tuple, system_message: str, text: str, image_base64: Optional[str] = None) -> str:
+        self.calls += 1
+        roll = random.random()
+        if roll < self.hang_rate:
+            await asyncio.Event().wait()
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if roll < self.hang_rate + self.failure_rate:
+            raise LlmTransientError("fake provider: injected failure")
+        return f"```json\n{self.response_text}\n```"
+    
+    async def stream(self, model: tuple, system_message: str, text: str, image_base64: Optional[str] = None):
+        """The canned reply in small chunks spread over the configured latency"""
+        self.calls += 1
+        roll = random.random()
+        if roll < self.hang_rate:
+            await asyncio.Event().wait()
+        reply = f"```json\n{self.response_text}\n```"
+        chunks = [reply[i:i + 16] for i in range(0, len(reply), 16)]
+        delay = (self.latency + random.uniform(0, self.jitter)) / len(chunks)
+        for i, chunk in enumerate(chunks):
+            await asyncio.sleep(delay)
+            if roll < self.hang_rate + self.failure_rate and i == len(chunks) // 2:
+                raise LlmTransientError("fake provider: injected failure")
+            yield chunk
 
-@api_router.get("/auth/me", response_model=User)
-async def get_me(current_user: Optional[User] = Depends(get_current_user)):
-    """Get current user"""
-    if not current_user:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    return current_user
+llm_provider = FakeLlmProvider() if LLM_PROVIDER == "fake" else EmergentLlmProvider()
 
-@api_router.post("/auth/logout")
-async def logout(request: Request, current_user: Optional[User] = Depends(get_current_user)):
-    """Logout user"""
-    if not current_user:
+llm_breakers: Dict[tuple, CircuitBreaker] = {}
+llm_admission = AdmissionController(LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE)
+
+# Admission priority of the LLM calls made for the current request (lower goes first)
+LLM_PRIORITY_PREMIUM = 0
+LLM_PRIORITY_STANDARD = 1
+llm_priority: ContextVar[int] = ContextVar("llm_priority", default=LLM_PRIORITY_STANDARD)
+
+def set_llm_priority(is_premium: bool):
+    llm_priority.set(LLM_PRIORITY_PREMIUM if is_premium else LLM_PRIORITY_STANDARD)
+llm_latency = LatencyRecorder()
+llm_stats: Dict[str, int] = {
+    "calls": 0,
+    "attempts": 0,
+    "retries": 0,
+    "timeouts": 0,
+    "transient_errors": 0,
+    "hedged": 0,
+    "hedge_wins": 0,
+    "breaker_rejections": 0,
+}
+
+def is_transient_llm_error(error: Exception) -> bool:
+    if isinstance(error, (LlmTransientError, asyncio.TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429 or status in RETRYABLE_STATUS_CODES
+
+def llm_unavailable(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="AI servisi şu anda yanıt vermiyor, lütfen biraz sonra tekrar deneyin",
+        headers={"Retry-After": str(max(1, int(retry_after + 0.5)))}
+    )
+
+async def send_hedged(send, timeout: float, hedge_after: float) -> str:
+    """One attempt, plus a duplicate request if the first is slower than hedge_after"""
+    if hedge_after <= 0 or hedge_after >= timeout:
+        return await asyncio.wait_for(send(), timeout)
+    
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    tasks = [asyncio.ensure_future(send())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            llm_stats["hedged"] += 1
+            tasks.append(asyncio.ensure_future(send()))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, timeout=max(0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                raise asyncio.TimeoutError()
+            for task in done:
+                if task.exception() is None:
+                    if task is not tasks[0]:
+                        llm_stats["hedge_wins"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def llm_breaker(model: tuple) -> CircuitBreaker:
+    return llm_breakers.setdefault(model, CircuitBreaker(LLM_BREAKER_FAILURE_THRESHOLD, LLM_BREAKER_RESET_SECONDS))
+
+def reject_if_breaker_open(model: tuple):
+    """Fail fast before queueing for a slot; half-open probing is left to the call"""
+    breaker = llm_breaker(model)
+    if breaker.state == "open":
+        llm_stats["breaker_rejections"] += 1
+        raise llm_unavailable(breaker.retry_after())
+
+async def call_llm(model: tuple, system_message: str, text: str, image_base64: Optional[str] = None) -> str:
+    """Send one prompt once admitted by llm_admission (429/503 with Retry-After when
+    the process is saturated), with a per-attempt timeout, jittered retries inside an
+    overall deadline and a per-model circuit breaker. Raises 503 with Retry-After when
+    the provider stays unavailable; non-transient errors propagate unchanged."""
+    reject_if_breaker_open(model)
+    async with llm_admission.slot(llm_priority.get(), LLM_ADMISSION_MAX_WAIT_SECONDS):
+        return await call_llm_with_retries(model, system_message, text, image_base64)
+
+async def call_llm_with_retries(model: tuple, system_message: str, text: str, image_base64: Optional[str] = None) -> str:
+    breaker = llm_breaker(model)
+    llm_stats["calls"] += 1
+    if not breaker.allow():
+        llm_stats["breaker_rejections"] += 1
+        raise llm_unavailable(breaker.retry_after())
+    
+    probe = breaker.probing
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + LLM_DEADLINE_SECONDS
+    send = lambda: llm_provider.send(model, system_message, text, image_base64)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        remaining = deadline - loop.time()
+        llm_stats["attempts"] += 1
+        try:
+            result = await send_hedged(send, min(LLM_TIMEOUT_SECONDS, remaining), LLM_HEDGE_AFTER_SECONDS)
+        except asyncio.CancelledError:
+            if probe:
+                breaker.probing = False  # let the next call probe instead
+            raise
+        except Exception as e:
+            if not is_transient_llm_error(e):
+                breaker.record_success()  # the provider answered, the request was bad
+                llm_latency.record_error()
+                raise
+            if isinstance(e, asyncio.TimeoutError):
+                llm_stats["timeouts"] += 1
+            else:
+                llm_stats["transient_errors"] += 1
+            logger.warning(f"LLM {model[1]} attempt {attempt + 1} failed: {e!r}")
+            
+            # Full jitter backoff, only if another attempt fits before the deadline
+            backoff = random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+            if attempt == LLM_MAX_RETRIES or loop.time() + backoff + 1 >= deadline:
+                break
+            llm_stats["retries"] += 1
+            await asyncio.sleep(backoff)
+        else:
+            breaker.record_success()
+            llm_latency.record(loop.time() - started)
+            return result
+    
+    breaker.record_failure()
+    llm_latency.record_error()
+    raise llm_unavailable(breaker.retry_after() or LLM_RETRY_MAX_SECONDS)
+
+async def stream_llm(model: tuple, system_message: str, text: str, image_base64: Optional[str] = None):
+    """Streaming counterpart of call_llm: yields reply chunks. Each chunk must arrive
+    within LLM_TIMEOUT_SECONDS; an attempt is only retried (without hedging) while
+    nothing has been yielded yet. The admission slot is held until the stream ends."""
+    reject_if_breaker_open(model)
+    async with llm_admission.slot(llm_priority.get(), LLM_ADMISSION_MAX_WAIT_SECONDS):
+        chunks = stream_llm_with_retries(model, system_message, text, image_base64)
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+async def stream_llm_with_retries(model: tuple, system_message: str, text: str, image_base64: Optional[str] = None):
+    breaker = llm_breaker(model)
+    llm_stats["calls"] += 1
+    if not breaker.allow():
+        llm_stats["breaker_rejections"] += 1
+        raise llm_unavailable(breaker.retry_after())
+    
+    probe = breaker.probing
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + LLM_DEADLINE_SECONDS
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        llm_stats["attempts"] += 1
+        chunks = llm_provider.stream(model, system_message, text, image_base64)
+        received = False
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        chunks.__anext__(), min(LLM_TIMEOUT_SECONDS, deadline - loop.time())
+                    )
+                except StopAsyncIteration:
+                    break
+                received = True
+                yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            if probe:
+                breaker.probing = False
+            raise
+        except Exception as e:
+            if not is_transient_llm_error(e):
+                breaker.record_success()
+                llm_latency.record_error()
+                raise
+            if isinstance(e, asyncio.TimeoutError):
+                llm_stats["timeouts"] += 1
+            else:
+                llm_stats["transient_errors"] += 1
+            logger.warning(f"LLM {model[1]} stream attempt {attempt + 1} failed: {e!r}")
+            
+            backoff = random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+            if received or attempt == LLM_MAX_RETRIES or loop.time() + backoff + 1 >= deadline:
+                break
+            llm_stats["retries"] += 1
+            await asyncio.sleep(backoff)
+        else:
+            breaker.record_success()
+            llm_latency.record(loop.time() - started)
+            return
+        finally:
+            await chunks.aclose()
+    
+    breaker.record_failure()
+    llm_latency.record_error()
+    raise llm_unavailable(breaker.retry_after() or LLM_RETRY_MAX_SECONDS)
+
+# Tolerant JSON extraction from model replies: prose and code fences around the
+# object, trailing commas, raw newlines in strings and replies cut off mid-array
+# are all recovered locally; a repair round trip is the caller's last resort.
+
+class LlmResponseFormatError(ValueError):
+    """Model answered but not with the JSON we asked for"""
+
+json_extract_stats: Dict[str, int] = {
+    "clean": 0,
+    "repaired": 0,
+    "llm_repaired": 0,
+    "failed": 0,
+    "items_dropped": 0,
+}
+
+def scan_json_object(text: str, start: int) -> tuple:
+    """From the "{" at start, return (end, cut, open_stack).
+    
+    end is the index after the balancing "}" or None if the text ends first; cut
+    is the last point where the prefix holds only complete values and open_stack
+    the brackets still open there, which is what a truncated reply is closed with.
+    Cuts fall between array elements or top-level keys, so a half-written item is
+    dropped rather than kept with missing fields.
+    """
+    stack = []
+    in_string = escaped = False
+    cut, cut_stack = start, []
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append(char)
+            if char == "[" or len(stack) == 1:
+                cut, cut_stack = i + 1, stack[:]
+        elif char in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                return i + 1, i + 1, []
+            if stack[-1] == "[" or len(stack) == 1:
+                cut, cut_stack = i + 1, stack[:]
+        elif char == "," and (stack[-1] == "[" or len(stack) == 1):
+            cut, cut_stack = i, stack[:]
+    return None, cut, cut_stack
+
+def strip_trailing_commas(fragment: str) -> str:
+    out = []
+    in_string = escaped = False
+    for i, char in enumerate(fragment):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == ",":
+            rest = fragment[i + 1:i + 64].lstrip()
+            if not rest or rest[0] in "}]":
+                continue
+        out.append(char)
+    return "".join(out)
+
+def extract_json_object(text: str) -> Dict[str, Any]:
+    """First JSON object in text, repairing trailing commas and truncation"""
+    start = text.find("{")
+    if start < 0:
+        raise LlmResponseFormatError("no JSON object in reply")
+    
+    # Prose may contain stray braces: take the first top-level object that parses as is
+    scans = []
+    while start >= 0 and len(scans) < 8:
+        end, cut, open_stack = scan_json_object(text, start)
+        scans.append((start, end, cut, open_stack))
+        if end is None:
+            break  # runs to the end of the reply, every later brace is inside it
+        try:
+            data = json.loads(text[start:end], strict=False)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            json_extract_stats["clean"] += 1
+            return data
+        start = text.find("{", end)
+    
+    # Otherwise repair the longest candidate; stray braces in prose are short
+    start, end, cut, open_stack = max(scans, key=lambda scan: (scan[1] or scan[2]) - scan[0])
+    if end is not None:
+        fragment = text[start:end]
+    else:
+        closers = {"{": "}", "[": "]"}
+        fragment = text[start:cut] + "".join(closers[char] for char in reversed(open_stack))
+    try:
+        data = json.loads(strip_trailing_commas(fragment), strict=False)
+    except ValueError as e:
+        raise LlmResponseFormatError(f"unrecoverable JSON: {e}")
+    if not isinstance(data, dict):
+        raise LlmResponseFormatError("reply is not a JSON object")
+    json_extract_stats["repaired"] += 1
+    return data
+
+def as_number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        match = re.match(r"\s*(-?\d+(?:[.,]\d+)?)", value)
+        if match:
+            return float(match.group(1).replace(",", "."))
+    return None
+
+def validate_detected_item(item: Any) -> Optional[Dict[str, Any]]:
+    """An items[] entry coerced to the fields DetectedFoodItem is built from, None if unusable"""
+    if not isinstance(item, dict) or not isinstance(item.get("label"), str) or not item["label"].strip():
+        return None
+    portion = item.get("portion") if isinstance(item.get("portion"), dict) else {}
+    estimate = as_number(portion.get("estimate_g"))
+    clean_portion = {"estimate_g": int(estimate) if estimate and estimate > 0 else 100}
+    range_g = portion.get("range_g")
+    if isinstance(range_g, list) and len(range_g) == 2 and all(as_number(v) is not None for v in range_g):
+        clean_portion["range_g"] = [int(as_number(v)) for v in range_g]
+    if isinstance(portion.get("basis"), str):
+        clean_portion["basis"] = portion["basis"]
+    confidence = as_number(item.get("confidence"))
+    aliases = item.get("aliases") if isinstance(item.get("aliases"), list) else []
+    return {
+        "label": item["label"].strip(),
+        "aliases": [alias for alias in aliases if isinstance(alias, str) and alias],
+        "portion": clean_portion,
+        "confidence": min(1.0, max(0.0, confidence)) if confidence is not None else 0.7
+    }
+
+def validate_detections(data: Dict[str, Any]) -> Dict[str, Any]:
+    items = data.get("items")
+    if not isinstance(items, list):
+        raise LlmResponseFormatError("items missing")
+    valid = [item for item in map(validate_detected_item, items) if item]
+    json_extract_stats["items_dropped"] += len(items) - len(valid)
+    notes = data.get("notes") if isinstance(data.get("notes"), list) else []
+    needs_confirmation = data.get("needs_user_confirmation")
+    return {
+        "items": valid,
+        "notes": [note for note in notes if isinstance(note, str)],
+        "needs_user_confirmation": needs_confirmation if isinstance(needs_confirmation, bool) else None
+    }
+
+def validate_food_analysis(data: Dict[str, Any]) -> AnalyzeFoodResponse:
+    values = {field: as_number(data.get(field)) for field in ("calories", "protein", "carbs", "fat")}
+    missing = [field for field, value in values.items() if value is None]
+    if missing:
+        raise LlmResponseFormatError(f"missing {', '.join(missing)}")
+    return AnalyzeFoodResponse(
+        calories=int(values["calories"]),
+        protein=values["protein"],
+        carbs=values["carbs"],
+        fat=values["fat"],
+        description=str(data.get("description") or "")
+    )
+
+JSON_REPAIR_SYSTEM_MESSAGE = "You repair malformed JSON. Reply with the corrected JSON object only."
+
+async def repair_llm_json(reply: str, schema: str) -> Dict[str, Any]:
+    """Last resort: one text-only round trip on the cheap model to rewrite a broken reply"""
+    repaired = await call_llm(
+        VISION_MODEL,
+        JSON_REPAIR_SYSTEM_MESSAGE,
+        f"Target shape:\n{schema}\n\nMalformed reply:\n{reply[:6000]}"
+    )
+    data = extract_json_object(repaired)
+    json_extract_stats["llm_repaired"] += 1
+    return data
+
+# ==================== AUTH ENDPOINTS ====================
+
+@api_router.post("/auth/session", response_model=SessionDataResponse)
+async def exchange_session(request: Request):
+    """Exchange session_id for session_token"""
+    session_id = request.headers.get("X-Session-ID")
+    
+    if not session_id:
+        raise HTTPException(status_code=400, detail="X-Session-ID header required")
+    
+    # Call Emergent Auth API
+    try:
+        user_data = await fetch_oauth_session_data(session_id)
+    except Exception as e:
+        logger.error(f"Error exchanging session: {e}")
+        raise HTTPException(status_code=400, detail="Invalid session ID")
+    
+    # Check if user exists
+    existing_user = await db.users.find_one(
+        {"email": user_data["email"]},
+        {"_id": 0}
+    )
+    
+    if existing_user:
+        user_doc = existing_user
+    else:
+        # Create new user
+        user_doc = {
+            "user_id": f"user_{uuid.uuid4().hex[:12]}",
+            "email": user_data["email"],
+            "name": user_data["name"],
+            "picture": user_data.get("picture"),
+            "created_at": datetime.now(timezone.utc),
+            "water_goal": 2500,
+            "step_goal": 10000
+        }
+        await db.users.insert_one(user_doc)
+    user_id = user_doc["user_id"]
+    
+    # Create session
+    session_token = await create_session(
+        user_doc, timedelta(days=7), session_token=user_data["session_token"]
+    )
+    
+    # Create response
+    response = JSONResponse(content={
+        "user_id": user_id,
+        "email": user_data["email"],
+        "name": user_data["name"],
+        "picture": user_data.get("picture"),
+        "session_token": session_token
+    })
+    
+    # Set cookie
+    response.set_cookie(
+        key="session_token",
+        value=session_token,
+        httponly=True,
+        secure=True,
+        samesite="none",
+        max_age=7 * 24 * 60 * 60,
+        path="/"
+    )
+    
+    return response
+
+@api_router.get("/auth/me", response_model=User)
+async def get_me(current_user: Optional[User] = Depends(get_current_user)):
+    """Get current user"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return current_user
+
+@api_router.post("/auth/logout")
+async def logout(request: Request, current_user: Optional[User] = Depends(get_current_user)):
+    """Logout user"""
+    if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    session_token = request.cookies.get("session_token")
+    session_token = get_session_token(request)
     if session_token:
+        session_cache.pop(session_token)
+        if session_token.startswith(SIGNED_TOKEN_PREFIX):
+            claims = verify_signed_token(session_token)
+            if claims:
+                await revoke_signed_token(claims)
         await db.user_sessions.delete_one({"session_token": session_token})
     
     response = JSONResponse(content={"message": "Logged out"})
@@ -431,27 +1732,22 @@ async def register(data: RegisterRequest):
     
     # Create user
     user_id = f"user_{uuid.uuid4().hex[:12]}"
-    session_token = f"sess_{uuid.uuid4().hex}"
     
-    await db.users.insert_one({
+    user_doc = {
         "user_id": user_id,
         "email": data.email,
         "name": data.name,
-        "password_hash": hash_password(data.password),
+        "password_hash": await hash_password(data.password),
         "auth_type": "email",
         "picture": None,
         "created_at": datetime.now(timezone.utc),
         "water_goal": 2500,
         "step_goal": 10000
-    })
+    }
+    await db.users.insert_one(user_doc)
     
     # Create session
-    await db.user_sessions.insert_one({
-        "user_id": user_id,
-        "session_token": session_token,
-        "expires_at": datetime.now(timezone.utc) + timedelta(days=30),
-        "created_at": datetime.now(timezone.utc)
-    })
+    session_token = await create_session(user_doc, timedelta(days=30))
     
     response = JSONResponse(content={
         "user_id": user_id,
@@ -483,19 +1779,22 @@ async def login(data: LoginRequest):
     
     # Check password
     if user.get("auth_type") == "email":
-        if not verify_password(data.password, user.get("password_hash", "")):
+        password_hash = user.get("password_hash", "")
+        matches, needs_rehash = await verify_password(data.password, password_hash)
+        if not matches:
             raise HTTPException(status_code=401, detail="Email veya şifre hatalı")
+        
+        # Upgrade legacy SHA-256 and low work factor hashes transparently
+        if needs_rehash:
+            await db.users.update_one(
+                {"user_id": user["user_id"], "password_hash": password_hash},
+                {"$set": {"password_hash": await hash_password(data.password)}}
+            )
     else:
         raise HTTPException(status_code=400, detail="Bu hesap Google ile oluşturuldu. Google ile giriş yapın.")
     
     # Create session
-    session_token = f"sess_{uuid.uuid4().hex}"
-    await db.user_sessions.insert_one({
-        "user_id": user["user_id"],
-        "session_token": session_token,
-        "expires_at": datetime.now(timezone.utc) + timedelta(days=30),
-        "created_at": datetime.now(timezone.utc)
-    })
+    session_token = await create_session(user, timedelta(days=30))
     
     response = JSONResponse(content={
         "user_id": user["user_id"],
@@ -521,10 +1820,9 @@ async def login(data: LoginRequest):
 async def guest_login():
     """Login as guest user"""
     user_id = f"guest_{uuid.uuid4().hex[:12]}"
-    session_token = f"sess_{uuid.uuid4().hex}"
     guest_name = f"Misafir_{uuid.uuid4().hex[:6]}"
     
-    await db.users.insert_one({
+    user_doc = {
         "user_id": user_id,
         "email": f"{user_id}@guest.local",
         "name": guest_name,
@@ -533,14 +1831,10 @@ async def guest_login():
         "created_at": datetime.now(timezone.utc),
         "water_goal": 2500,
         "step_goal": 10000
-    })
+    }
+    await db.users.insert_one(user_doc)
     
-    await db.user_sessions.insert_one({
-        "user_id": user_id,
-        "session_token": session_token,
-        "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
-        "created_at": datetime.now(timezone.utc)
-    })
+    session_token = await create_session(user_doc, timedelta(days=7))
     
     response = JSONResponse(content={
         "user_id": user_id,
@@ -596,307 +1890,1606 @@ async def update_profile(
         {"$set": update_data}
     )
     
-    # Get updated user
-    user_doc = await db.users.find_one(
-        {"user_id": current_user.user_id},
-        {"_id": 0}
+    # Get updated user
+    user_doc = await db.users.find_one(
+        {"user_id": current_user.user_id},
+        {"_id": 0}
+    )
+    await sync_user_sessions(current_user.user_id, user_doc)
+    
+    return User(**user_doc)
+
+# ==================== USER ENDPOINTS ====================
+
+@api_router.get("/user/profile", response_model=User)
+async def get_profile(current_user: Optional[User] = Depends(get_current_user)):
+    """Get user profile"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return current_user
+
+@api_router.put("/user/goals", response_model=User)
+async def update_goals(
+    goals: UpdateGoals,
+    current_user: Optional[User] = Depends(get_current_user)
+):
+    """Update user goals"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    update_data = goals.dict(exclude_none=True)
+    
+    await db.users.update_one(
+        {"user_id": current_user.user_id},
+        {"$set": update_data}
+    )
+    
+    user_doc = await db.users.find_one(
+        {"user_id": current_user.user_id},
+        {"_id": 0}
+    )
+    await sync_user_sessions(current_user.user_id, user_doc)
+    
+    return User(**user_doc)
+
+# ==================== FOOD ENDPOINTS ====================
+
+@api_router.post("/food/analyze", response_model=AnalyzeFoodResponse)
+async def analyze_food(
+    request_data: AnalyzeFoodRequest,
+    response: Response,
+    current_user: Optional[User] = Depends(get_current_user)
+):
+    """Analyze food image (Legacy endpoint, served by the /meal/vision pipeline)"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    return await run_food_analysis(decode_image_base64(request_data.image_base64), current_user, response)
+
+@api_router.post("/food/analyze/upload", response_model=AnalyzeFoodResponse)
+async def analyze_food_upload(
+    response: Response,
+    image: UploadFile = File(...),
+    current_user: Optional[User] = Depends(get_current_user)
+):
+    """Multipart variant of /food/analyze: raw image bytes instead of base64 JSON"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    return await run_food_analysis(await read_upload_image(image), current_user, response)
+
+async def run_food_analysis(image_bytes: bytes, current_user: User, response: Response) -> AnalyzeFoodResponse:
+    """Legacy shape over the vision pipeline: same caches, preprocessing and model cascade,
+    items collapsed into meal totals and a one-line description"""
+    set_llm_priority(current_user.is_premium)
+    try:
+        trace = new_vision_trace()
+        detections = await get_vision_detections(
+            get_cache_key(image_bytes), image_bytes, trace, current_user.user_id
+        )
+        result = await build_vision_result(detections, "tr-TR")
+        apply_vision_trace(response, trace)
+        
+        description = ", ".join(
+            f"{item['label']} ({item['portion']['estimate_g']} g)" for item in result["items"]
+        )
+        return AnalyzeFoodResponse(
+            calories=result["total_calories"],
+            protein=result["total_protein"],
+            carbs=result["total_carbs"],
+            fat=result["total_fat"],
+            description=description or "Yemek tespit edilemedi"
+        )
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error analyzing food: {e}")
+        raise HTTPException(status_code=500, detail=f"Error analyzing food: {str(e)}")
+
+# Vision cache for cost optimization, bounded by entries, bytes and age.
+# L1 (this worker) in front of the shared vision_results collection (all workers).
+# Both are keyed by the image content only and hold what the model saw in the
+# image; nutrition mapping runs per request on top of it.
+vision_cache = BoundedTTLCache(VISION_CACHE_MAX_ENTRIES, VISION_CACHE_TTL_SECONDS, VISION_CACHE_MAX_BYTES)
+
+vision_stats: Dict[str, int] = {
+    "l1_hits": 0,
+    "l2_hits": 0,
+    "near_duplicate_hits": 0,
+    "llm_calls": 0,
+}
+
+# Image decoding is CPU bound, keep it off the event loop
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+class HammingIndex:
+    """Multi-index hashing over 64-bit perceptual hashes.
+    
+    Hashes are cut into max_distance + 1 bit segments with one lookup table per
+    segment. By pigeonhole, any hash within max_distance of a query agrees with it
+    exactly on at least one segment, so only those buckets need a popcount check.
+    Past max_entries the oldest hashes are dropped.
+    """
+    
+    def __init__(self, max_distance: int, max_entries: int):
+        self.max_distance = max(0, min(max_distance, 63))
+        segments = self.max_distance + 1
+        bounds = [64 * i // segments for i in range(segments + 1)]
+        self.segments = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self.tables: List[Dict[int, List[int]]] = [{} for _ in self.segments]
+        self.keys: "OrderedDict[int, str]" = OrderedDict()  # oldest first
+        self.max_entries = max_entries
+        self.evictions = 0
+    
+    @property
+    def size(self) -> int:
+        return len(self.keys)
+    
+    def add(self, value: int, key: str):
+        if value in self.keys:
+            return  # identical hash already indexed
+        self.keys[value] = key
+        for table, (shift, mask) in zip(self.tables, self.segments):
+            table.setdefault((value >> shift) & mask, []).append(value)
+        while len(self.keys) > self.max_entries:
+            self.remove(next(iter(self.keys)))
+            self.evictions += 1
+    
+    def remove(self, value: int):
+        if self.keys.pop(value, None) is None:
+            return
+        for table, (shift, mask) in zip(self.tables, self.segments):
+            segment = (value >> shift) & mask
+            bucket = table[segment]
+            bucket.remove(value)
+            if not bucket:
+                del table[segment]
+    
+    def search(self, value: int) -> List[tuple]:
+        """All (distance, key) within max_distance of value"""
+        candidates = set()
+        for table, (shift, mask) in zip(self.tables, self.segments):
+            candidates.update(table.get((value >> shift) & mask, ()))
+        results = []
+        for candidate in candidates:
+            distance = (candidate ^ value).bit_count()
+            if distance <= self.max_distance:
+                results.append((distance, self.keys[candidate]))
+        return results
+    
+    def nearest(self, values: List[int]) -> Optional[tuple]:
+        """Closest (distance, key) to any of values, None if nothing is within range"""
+        matches = [match for value in values for match in self.search(value)]
+        return min(matches) if matches else None
+
+# image hash -> in-flight analysis; "coalesced" counts LLM calls saved
+vision_flights = SingleFlight()
+
+# phash -> image hash of the newest stored vision results, synced from vision_results
+phash_index = HammingIndex(VISION_PHASH_MAX_DISTANCE, VISION_PHASH_MAX_ENTRIES)
+phash_index_synced_at: Optional[datetime] = None
+phash_index_built_at: Optional[datetime] = None
+
+def dhash(image: "Image.Image") -> int:
+    """64-bit difference hash: brightness gradients of a 9x8 grayscale thumbnail"""
+    pixels = image.convert("L").resize((9, 8), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+def image_phashes(image: "Image.Image") -> List[int]:
+    """dHash of the upright image followed by its 90/180/270 degree rotations"""
+    small = image.convert("L").resize((64, 64), Image.BILINEAR)
+    return [dhash(small)] + [dhash(small.rotate(angle)) for angle in (90, 180, 270)]
+
+class PreparedImage(NamedTuple):
+    image_base64: str  # what the LLM receives
+    phashes: Optional[List[int]]
+    bytes_in: int
+    bytes_out: int
+    timings: Dict[str, float]  # ms per stage
+
+def preprocess_image(image_bytes: bytes) -> PreparedImage:
+    """Decode once, bake in EXIF orientation, downscale and re-encode without metadata"""
+    timings = {}
+    started = time.perf_counter()
+    
+    def lap(stage: str):
+        nonlocal started
+        now = time.perf_counter()
+        timings[stage] = round((now - started) * 1000, 2)
+        started = now
+    
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            # JPEG: let the decoder skip straight to the smallest scale >= target
+            image.draft("RGB", (VISION_MAX_DIMENSION, VISION_MAX_DIMENSION))
+            image.load()
+            lap("decode")
+            
+            image = ImageOps.exif_transpose(image)
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            image.thumbnail((VISION_MAX_DIMENSION, VISION_MAX_DIMENSION), Image.LANCZOS)
+            lap("resize")
+            
+            phashes = image_phashes(image)
+            lap("phash")
+            
+            # Saved without exif=..., so GPS and camera metadata are dropped
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+            encoded = buffer.getvalue()
+            image_base64 = base64.b64encode(encoded).decode()
+            lap("encode")
+    except Exception as e:
+        # Formats PIL cannot read still reach the model untouched
+        logger.warning(f"Could not preprocess image, sending original: {e}")
+        return PreparedImage(
+            image_base64=base64.b64encode(image_bytes).decode(),
+            phashes=None,
+            bytes_in=len(image_bytes),
+            bytes_out=len(image_bytes),
+            timings=timings
+        )
+    
+    return PreparedImage(
+        image_base64=image_base64,
+        phashes=phashes,
+        bytes_in=len(image_bytes),
+        bytes_out=len(encoded),
+        timings=timings
+    )
+
+preprocess_stats: Dict[str, int] = {
+    "images": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+}
+preprocess_latency: Dict[str, LatencyRecorder] = {
+    stage: LatencyRecorder() for stage in ("decode", "resize", "phash", "encode")
+}
+
+async def prepare_image(image_bytes: bytes, trace: Optional[Dict[str, Any]] = None) -> PreparedImage:
+    """Run preprocess_image in the image pool and record its stage timings"""
+    loop = asyncio.get_running_loop()
+    prepared = await loop.run_in_executor(image_executor, preprocess_image, image_bytes)
+    
+    preprocess_stats["images"] += 1
+    preprocess_stats["bytes_in"] += prepared.bytes_in
+    preprocess_stats["bytes_out"] += prepared.bytes_out
+    for stage, ms in prepared.timings.items():
+        preprocess_latency[stage].record(ms / 1000)
+    
+    if trace is not None:
+        trace["timings"].update(prepared.timings)
+        trace["bytes_in"] = prepared.bytes_in
+        trace["bytes_out"] = prepared.bytes_out
+    logger.info(f"Image preprocessed: {prepared.bytes_in} -> {prepared.bytes_out} bytes, {prepared.timings}")
+    return prepared
+
+def new_vision_trace() -> Dict[str, Any]:
+    """Per-request record of where a vision result came from and what it cost"""
+    return {"source": None, "timings": {}, "bytes_in": None, "bytes_out": None}
+
+def apply_vision_trace(response: Response, trace: Dict[str, Any]):
+    """Expose per-stage timings (Server-Timing) and byte reduction on the response"""
+    if trace["source"]:
+        response.headers["X-Vision-Source"] = trace["source"]
+    if trace["timings"]:
+        response.headers["Server-Timing"] = ", ".join(
+            f"{stage};dur={ms}" for stage, ms in trace["timings"].items()
+        )
+    if trace["bytes_in"] is not None:
+        response.headers["X-Image-Bytes-In"] = str(trace["bytes_in"])
+        response.headers["X-Image-Bytes-Out"] = str(trace["bytes_out"])
+
+async def rebuild_phash_index():
+    """Fresh index of the newest unexpired results, swapped in whole"""
+    global phash_index, phash_index_built_at, phash_index_synced_at
+    now = datetime.now(timezone.utc)
+    docs = await db.vision_results.find(
+        {"phash": {"$exists": True}, "expires_at": {"$gt": now}},
+        {"phash": 1}
+    ).sort("created_at", -1).limit(VISION_PHASH_MAX_ENTRIES).to_list(None)
+    
+    index = HammingIndex(VISION_PHASH_MAX_DISTANCE, VISION_PHASH_MAX_ENTRIES)
+    for doc in reversed(docs):  # oldest first, so eviction order follows age
+        index.add(int(doc["phash"], 16), doc["_id"])
+    phash_index = index
+    phash_index_built_at = phash_index_synced_at = now
+
+async def sync_phash_index():
+    """Add perceptual hashes of results stored by any worker since the last sync,
+    rebuilding from scratch every VISION_PHASH_REBUILD_SECONDS"""
+    global phash_index_synced_at
+    now = datetime.now(timezone.utc)
+    if phash_index_built_at is None or (now - phash_index_built_at).total_seconds() >= VISION_PHASH_REBUILD_SECONDS:
+        await rebuild_phash_index()
+        return
+    
+    query = {
+        "phash": {"$exists": True},
+        "created_at": {"$gte": phash_index_synced_at - timedelta(seconds=30)}
+    }
+    async for doc in db.vision_results.find(query, {"phash": 1}):
+        phash_index.add(int(doc["phash"], 16), doc["_id"])
+    phash_index_synced_at = now
+
+VISION_MODEL = ("openai", VISION_FAST_MODEL)  # Cost optimized model
+DETECTIONS_JSON_SHAPE = (
+    '{"items": [{"label": str, "aliases": [str], "portion": {"estimate_g": number, '
+    '"range_g": [number, number], "basis": str}, "confidence": number}], '
+    '"notes": [str], "needs_user_confirmation": bool}'
+)
+VISION_TIERS = {
+    "fast": (VISION_MODEL, VISION_FAST_COST_USD),
+    "strong": (("openai", VISION_STRONG_MODEL), VISION_STRONG_COST_USD),
+}
+
+VISION_SYSTEM_MESSAGE = """Sen bir beslenme uzmanısın. Yemek fotoğraflarını analiz et.
+KURALLAR:
+- SADECE yemekleri tespit et ve porsiyon tahmini yap
+- Kalori/makro değerleri VERME (veritabanından alınacak)
+- Türk yemeklerini tanı
+- Emin değilsen birden fazla alternatif ver
+- JSON formatında yanıt ver"""
+
+# Vision prompt (minimal for cost)
+VISION_PROMPT = """Bu yemek fotoğrafını analiz et.
+
+JSON formatında yanıt ver:
+{
+  "items": [
+    {
+      "label": "yemek adı",
+      "aliases": ["alternatif isim"],
+      "portion": {
+        "estimate_g": 180,
+        "range_g": [140, 240],
+        "basis": "visual_estimate"
+      },
+      "confidence": 0.85
+    }
+  ],
+  "notes": ["not varsa"],
+  "needs_user_confirmation": false
+}
+
+Sadece JSON yanıt ver, başka açıklama yapma."""
+
+def decode_image_base64(image_base64: str) -> bytes:
+    """Decode a (possibly data-URI prefixed) base64 image, 400 if it is not one"""
+    if image_base64.startswith("data:") and "," in image_base64:
+        image_base64 = image_base64.split(",", 1)[1]
+    try:
+        image_bytes = base64.b64decode(image_base64)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Geçersiz görsel verisi")
+    if not image_bytes:
+        raise HTTPException(status_code=400, detail="Geçersiz görsel verisi")
+    return image_bytes
+
+def get_cache_key(image_bytes: bytes) -> str:
+    """Content address of an image: SHA-256 of the full decoded bytes"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+async def detect_foods(image_base64: str, model: tuple = VISION_MODEL) -> Dict[str, Any]:
+    """Ask the vision model what is on the plate, returns its parsed JSON"""
+    # Get response
+    vision_stats["llm_calls"] += 1
+    response = await call_llm(model, VISION_SYSTEM_MESSAGE, VISION_PROMPT, image_base64)
+    try:
+        return parse_detections(response)
+    except LlmResponseFormatError as e:
+        logger.warning(f"Vision reply not parseable ({e}), asking for a repair: {response[:200]}")
+    try:
+        return validate_detections(await repair_llm_json(response, DETECTIONS_JSON_SHAPE))
+    except LlmResponseFormatError:
+        json_extract_stats["failed"] += 1
+        raise
+
+def parse_detections(response: str) -> Dict[str, Any]:
+    """Detections from the vision model's reply, LlmResponseFormatError if none can be recovered"""
+    return validate_detections(extract_json_object(response))
+
+ITEMS_ARRAY_RE = re.compile(r'"items"\s*:\s*\[')
+
+class IncrementalItemParser:
+    """Pull complete objects out of the "items" array of a reply still being streamed"""
+    
+    def __init__(self):
+        self.text = ""
+        self.items: List[Dict[str, Any]] = []
+        self._pos = 0
+        self._state = "seek"  # seek -> array -> done
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._item_start = 0
+    
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """Append a chunk, return the items it completed"""
+        self.text += chunk
+        found = []
+        if self._state == "seek":
+            match = ITEMS_ARRAY_RE.search(self.text, self._pos)
+            if not match:
+                # Keep enough tail to catch a key split across chunks
+                self._pos = max(self._pos, len(self.text) - 32)
+                return found
+            self._pos = match.end()
+            self._state = "array"
+        
+        text = self.text
+        while self._state == "array" and self._pos < len(text):
+            char = text[self._pos]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    self._item_start = self._pos
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        item = validate_detected_item(json.loads(text[self._item_start:self._pos + 1], strict=False))
+                    except ValueError:
+                        item = None
+                    if item:
+                        found.append(item)
+            elif char == "]" and self._depth == 0:
+                self._state = "done"
+            self._pos += 1
+        
+        self.items.extend(found)
+        return found
+
+vision_tier_stats = {
+    tier: {"calls": 0, "estimated_cost_usd": 0.0, "latency": LatencyRecorder()}
+    for tier in VISION_TIERS
+}
+vision_escalation_stats = {
+    "analyses": 0,
+    "escalations": 0,
+    "budget_denied": 0,
+    "strong_failures": 0,
+    "reasons": Counter(),
+}
+
+def escalation_reason(detections: Optional[Dict[str, Any]]) -> Optional[str]:
+    if detections is None:
+        return "parse_error"
+    if detections.get("needs_user_confirmation"):
+        return "needs_confirmation"
+    if any(item.get("confidence", 1.0) < VISION_ESCALATION_CONFIDENCE for item in detections["items"]):
+        return "low_confidence"
+    return None
+
+async def charge_escalation_budget(key: str, limit: int, expires_at: datetime) -> bool:
+    """One unit of a daily budget, False once it is spent.
+    
+    The conditional upsert only matches while count is under the limit; once it
+    is reached the upsert collides with the existing _id and raises. Two first
+    upserts of the day also collide, so the loser retries once against the
+    document the winner created before treating the budget as spent."""
+    if limit <= 0:
+        return False
+    for attempt in range(2):
+        try:
+            await db.escalation_budgets.update_one(
+                {"_id": key, "count": {"$lt": limit}},
+                {"$inc": {"count": 1}, "$setOnInsert": {"expires_at": expires_at}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            pass
+    return False
+
+async def consume_escalation_budget(user_id: Optional[str]) -> bool:
+    """Take one escalation from today's per-user and global budgets, atomically"""
+    now = datetime.now(timezone.utc)
+    day = now.strftime("%Y-%m-%d")
+    scopes = [(f"{day}:global", VISION_ESCALATION_GLOBAL_DAILY_BUDGET)]
+    if user_id:
+        scopes.insert(0, (f"{day}:user:{user_id}", VISION_ESCALATION_USER_DAILY_BUDGET))
+    
+    charged = []
+    for key, limit in scopes:
+        if not await charge_escalation_budget(key, limit, now + timedelta(days=2)):
+            for charged_key in charged:
+                await db.escalation_budgets.update_one({"_id": charged_key}, {"$inc": {"count": -1}})
+            return False
+        charged.append(key)
+    return True
+
+def record_tier_call(tier: str, seconds: Optional[float]):
+    """Count one model call of a tier; seconds is None when it failed"""
+    stats = vision_tier_stats[tier]
+    stats["calls"] += 1
+    stats["estimated_cost_usd"] += VISION_TIERS[tier][1]
+    if seconds is None:
+        stats["latency"].record_error()
+    else:
+        stats["latency"].record(seconds)
+
+async def detect_foods_with_tier(image_base64: str, tier: str) -> Optional[Dict[str, Any]]:
+    """One tier's detections, None if its output did not parse"""
+    started = time.perf_counter()
+    try:
+        detections = await detect_foods(image_base64, VISION_TIERS[tier][0])
+    except LlmResponseFormatError:
+        record_tier_call(tier, None)
+        return None
+    except Exception:
+        record_tier_call(tier, None)
+        raise
+    record_tier_call(tier, time.perf_counter() - started)
+    return dict(detections, model_tier=tier)
+
+async def run_vision_cascade(image_base64: str, user_id: Optional[str]) -> Dict[str, Any]:
+    """Fast model first, the strong model only when the fast answer is doubtful"""
+    vision_escalation_stats["analyses"] += 1
+    detections = await detect_foods_with_tier(image_base64, "fast")
+    return await escalate_if_unsure(image_base64, user_id, detections)
+
+async def stream_vision_cascade(image_base64: str, user_id: Optional[str], items: asyncio.Queue) -> Dict[str, Any]:
+    """run_vision_cascade with the fast tier streamed: each item is put on items as soon
+    as the model has named it. Only the queue is touched while the reply streams, so a
+    slow consumer never holds the LLM admission slot."""
+    vision_stats["llm_calls"] += 1
+    vision_escalation_stats["analyses"] += 1
+    parser = IncrementalItemParser()
+    started = time.perf_counter()
+    try:
+        async for chunk in stream_llm(VISION_MODEL, VISION_SYSTEM_MESSAGE, VISION_PROMPT, image_base64):
+            for item_data in parser.feed(chunk):
+                items.put_nowait(item_data)
+    except Exception:
+        record_tier_call("fast", None)
+        raise
+    record_tier_call("fast", time.perf_counter() - started)
+    
+    try:
+        detections = dict(parse_detections(parser.text), model_tier="fast")
+    except LlmResponseFormatError:
+        detections = None
+        if parser.items:
+            detections = {"items": parser.items, "notes": [], "needs_user_confirmation": None, "model_tier": "fast"}
+    return await escalate_if_unsure(image_base64, user_id, detections)
+
+async def escalate_if_unsure(
+    image_base64: str,
+    user_id: Optional[str],
+    detections: Optional[Dict[str, Any]]
+) -> Dict[str, Any]:
+    """The strong tier's detections when the fast ones (None: unparsable) are doubtful
+    and the budget allows, else the fast ones"""
+    reason = escalation_reason(detections)
+    if reason is None:
+        return detections
+    
+    if not await consume_escalation_budget(user_id):
+        vision_escalation_stats["budget_denied"] += 1
+    else:
+        vision_escalation_stats["escalations"] += 1
+        vision_escalation_stats["reasons"][reason] += 1
+        try:
+            strong = await detect_foods_with_tier(image_base64, "strong")
+        except HTTPException:
+            if detections is None:
+                raise
+            strong = None
+        if strong is not None:
+            return strong
+        vision_escalation_stats["strong_failures"] += 1
+    
+    if detections is None:
+        raise HTTPException(status_code=500, detail="AI yanıt formatı hatalı, tekrar deneyin")
+    return detections
+
+async def find_cached_detections(image_hash: str) -> Optional[Dict[str, Any]]:
+    """Detections stored for exactly this image in L1 or vision_results"""
+    detections = vision_cache.get(image_hash)
+    if detections is not None:
+        vision_stats["l1_hits"] += 1
+        return detections
+    
+    stored = await db.vision_results.find_one({"_id": image_hash}, {"detections": 1})
+    if not stored:
+        return None
+    
+    vision_stats["l2_hits"] += 1
+    detections = stored["detections"]
+    vision_cache.set(image_hash, detections, size=len(json.dumps(detections)))
+    return detections
+
+def request_body_limit(path: str) -> int:
+    """Largest body accepted for a path: one image (batches: VISION_BATCH_MAX_IMAGES),
+    sized for base64 JSON, which is a third larger than the same file in multipart"""
+    images = VISION_BATCH_MAX_IMAGES if path.startswith("/api/meal/vision/batch") else 1
+    return images * (MAX_IMAGE_UPLOAD_BYTES * 4 // 3) + REQUEST_BODY_OVERHEAD_BYTES
+
+class BodySizeLimitMiddleware:
+    """413 for request bodies over request_body_limit while they arrive: up front from
+    Content-Length, else as soon as the streamed body passes the limit. Starlette
+    spools multipart files to disk before the handler runs, so the per-image check in
+    read_upload_image alone would only fire after the whole upload was received."""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        limit = request_body_limit(scope["path"])
+        too_large = HTTPException(status_code=413, detail="İstek çok büyük")
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse({"detail": too_large.detail}, status_code=413, headers={"Connection": "close"})
+            await response(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # FastAPI re-raises HTTPExceptions from body parsing, the route answers 413
+                    raise too_large
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+async def read_upload_image(upload: UploadFile) -> bytes:
+    """Copy an uploaded image (already size-limited by BodySizeLimitMiddleware) into one
+    buffer, 413 once it exceeds MAX_IMAGE_UPLOAD_BYTES"""
+    buffer = bytearray()
+    while True:
+        chunk = await upload.read(64 * 1024)
+        if not chunk:
+            break
+        buffer.extend(chunk)
+        if len(buffer) > MAX_IMAGE_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Görsel çok büyük")
+    if not buffer:
+        raise HTTPException(status_code=400, detail="Geçersiz görsel verisi")
+    return bytes(buffer)
+
+async def get_vision_detections(
+    image_hash: str,
+    image_bytes: bytes,
+    trace: Optional[Dict[str, Any]] = None,
+    user_id: Optional[str] = None,
+    items: Optional[asyncio.Queue] = None
+) -> Dict[str, Any]:
+    """Detections for an image: exact cache, then a near-duplicate photo, then the model.
+    With items, a model call made for this caller streams its items onto that queue."""
+    trace = trace if trace is not None else new_vision_trace()
+    detections = await find_cached_detections(image_hash)
+    if detections is not None:
+        trace["source"] = "cache"
+        return detections
+    
+    # Double submits and concurrent uploads of one photo share a single analysis
+    trace["source"] = "coalesced"
+    return await vision_flights.do(
+        image_hash,
+        lambda: analyze_uncached_image(image_hash, image_bytes, trace, user_id, items)
+    )
+
+async def analyze_uncached_image(
+    image_hash: str,
+    image_bytes: bytes,
+    trace: Dict[str, Any],
+    user_id: Optional[str] = None,
+    items: Optional[asyncio.Queue] = None
+) -> Dict[str, Any]:
+    prepared = await prepare_image(image_bytes, trace)
+    phashes = prepared.phashes
+    
+    detections = await find_near_duplicate_detections(image_hash, phashes)
+    if detections is not None:
+        trace["source"] = "near_duplicate"
+        return detections
+    
+    trace["source"] = "llm"
+    started = time.perf_counter()
+    if items is None:
+        detections = await run_vision_cascade(prepared.image_base64, user_id)
+    else:
+        detections = await stream_vision_cascade(prepared.image_base64, user_id, items)
+    trace["timings"]["llm"] = round((time.perf_counter() - started) * 1000, 2)
+    
+    await store_detections(image_hash, detections, phashes)
+    return detections
+
+async def find_near_duplicate_detections(image_hash: str, phashes: List[int]) -> Optional[Dict[str, Any]]:
+    """Detections of a cropped, rotated or re-compressed copy of an analyzed photo"""
+    if not phashes:
+        return None
+    match = phash_index.nearest(phashes)
+    if not match:
+        return None
+    detections = await find_cached_detections(match[1])
+    if detections is not None:
+        vision_stats["near_duplicate_hits"] += 1
+        vision_cache.set(image_hash, detections, size=len(json.dumps(detections)))
+    return detections
+
+async def store_detections(image_hash: str, detections: Dict[str, Any], phashes: List[int]):
+    """Cache fresh model output in L1, vision_results and the near-duplicate index"""
+    now = datetime.now(timezone.utc)
+    stored = {
+        "detections": detections,
+        "model": VISION_TIERS[detections["model_tier"]][0][1],
+        "created_at": now,
+        "expires_at": now + timedelta(days=VISION_RESULT_TTL_DAYS)
+    }
+    if phashes:
+        stored["phash"] = f"{phashes[0]:016x}"
+        phash_index.add(phashes[0], image_hash)
+    await db.vision_results.update_one(
+        {"_id": image_hash},
+        {"$setOnInsert": stored},
+        upsert=True
+    )
+    
+    vision_cache.set(image_hash, detections, size=len(json.dumps(detections)))
+
+# Food name index: the foods catalog held in memory for name lookups
+
+# Turkish-aware folding: İ/I and ı all become i, then diacritics are dropped so
+# "KÖFTE", "köfte" and "kofte" share one key
+TURKISH_FOLD = str.maketrans({"ı": "i", "ş": "s", "ğ": "g", "ç": "c", "ö": "o", "ü": "u", "â": "a", "î": "i", "û": "u"})
+PORTION_SUFFIX_RE = re.compile(r"\s*\([^)]*\)\s*$")  # "Köfte (1 Porsiyon)" -> "Köfte"
+NON_WORD_RE = re.compile(r"[^0-9a-z]+")
+
+def fold_food_name(name: str) -> str:
+    """Normalized lookup key: portion suffix stripped, Turkish case/diacritics folded"""
+    name = PORTION_SUFFIX_RE.sub("", name).replace("İ", "i").replace("I", "i").lower()
+    return NON_WORD_RE.sub(" ", name.translate(TURKISH_FOLD)).strip()
+
+# Folded plural/possessive endings: köfteler -> kofte, çorbası -> corba
+TURKISH_SUFFIXES = ("leri", "lari", "ler", "lar", "si", "su", "i", "u")
+
+def stem_food_token(token: str) -> str:
+    for _ in range(2):
+        for suffix in TURKISH_SUFFIXES:
+            if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+                token = token[:-len(suffix)]
+                break
+        else:
+            break
+    return token
+
+def food_trigrams(key: str) -> set:
+    """Character trigrams of a folded name, tokens stemmed and padded at word edges"""
+    padded = " " + " ".join(stem_food_token(token) for token in key.split()) + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def trigram_similarity(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+class FoodMatch(NamedTuple):
+    food: Dict[str, Any]
+    match_type: str  # exact | partial | fuzzy
+    score: float
+
+class FoodNameIndex:
+    """In-memory index of the foods catalog for exact and token-prefix name lookups"""
+    
+    def __init__(self):
+        self.docs: Dict[str, Dict[str, Any]] = {}  # str(_id) -> food without _id
+        self.keys: Dict[str, str] = {}  # str(_id) -> folded name
+        self.order: Dict[str, int] = {}  # catalog order, ties resolve like find_one
+        self.exact: Dict[str, set] = {}  # folded name -> ids
+        self.tokens: Dict[str, set] = {}  # name token -> ids
+        self.sorted_tokens: List[str] = []  # for prefix range scans
+        self.best: Dict[str, str] = {}  # token -> first id among its foods, filled lazily
+        self.trigrams: Dict[str, set] = {}  # stemmed name trigram -> ids
+        self._seq = 0
+    
+    @classmethod
+    def build(cls, docs: List[Dict[str, Any]]) -> "FoodNameIndex":
+        index = cls()
+        for doc in docs:
+            index.upsert(doc, _sort=False)
+        index.sorted_tokens = sorted(index.tokens)
+        return index
+    
+    @property
+    def size(self) -> int:
+        return len(self.docs)
+    
+    def upsert(self, doc: Dict[str, Any], _sort: bool = True):
+        doc_id = str(doc["_id"])
+        food = {k: v for k, v in doc.items() if k != "_id"}
+        if doc_id in self.docs:
+            if self.docs[doc_id] == food:
+                return
+            self.remove(doc_id, _keep_order=True)
+        
+        key = fold_food_name(food.get("name", ""))
+        self.docs[doc_id] = food
+        self.keys[doc_id] = key
+        if doc_id not in self.order:
+            self.order[doc_id] = self._seq
+            self._seq += 1
+        self.exact.setdefault(key, set()).add(doc_id)
+        for token in set(key.split()):
+            self.best.pop(token, None)
+            ids = self.tokens.get(token)
+            if ids is None:
+                ids = self.tokens[token] = set()
+                if _sort:
+                    bisect.insort(self.sorted_tokens, token)
+            ids.add(doc_id)
+        for trigram in food_trigrams(key):
+            self.trigrams.setdefault(trigram, set()).add(doc_id)
+    
+    def remove(self, doc_id: str, _keep_order: bool = False):
+        if doc_id not in self.docs:
+            return
+        key = self.keys.pop(doc_id)
+        del self.docs[doc_id]
+        if not _keep_order:
+            del self.order[doc_id]
+        self.exact[key].discard(doc_id)
+        if not self.exact[key]:
+            del self.exact[key]
+        for token in set(key.split()):
+            self.best.pop(token, None)
+            self.tokens[token].discard(doc_id)
+            if not self.tokens[token]:
+                del self.tokens[token]
+                position = bisect.bisect_left(self.sorted_tokens, token)
+                if position < len(self.sorted_tokens) and self.sorted_tokens[position] == token:
+                    del self.sorted_tokens[position]
+        for trigram in food_trigrams(key):
+            self.trigrams[trigram].discard(doc_id)
+            if not self.trigrams[trigram]:
+                del self.trigrams[trigram]
+    
+    def _prefix_tokens(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self.sorted_tokens, prefix)
+        end = start
+        while end < len(self.sorted_tokens) and self.sorted_tokens[end].startswith(prefix):
+            end += 1
+        return self.sorted_tokens[start:end]
+    
+    def _first_id(self, ids) -> str:
+        return min(ids, key=lambda doc_id: (len(self.keys[doc_id]), self.order[doc_id]))
+    
+    def _best_for_token(self, token: str) -> str:
+        best = self.best.get(token)
+        if best is None:
+            best = self.best[token] = self._first_id(self.tokens[token])
+        return best
+    
+    def find_exact(self, term: str) -> Optional[Dict[str, Any]]:
+        ids = self.exact.get(fold_food_name(term))
+        return self.docs[self._first_id(ids)] if ids else None
+    
+    def find_partial(self, term: str) -> Optional[Dict[str, Any]]:
+        """Food whose name tokens start with every token of term, shortest name first"""
+        query_tokens = fold_food_name(term).split()
+        if not query_tokens:
+            return None
+        candidates = []
+        for query_token in set(query_tokens):
+            tokens = self._prefix_tokens(query_token)
+            if not tokens:
+                return None
+            candidates.append((sum(len(self.tokens[token]) for token in tokens), query_token, tokens))
+        candidates.sort()
+        
+        _, _, tokens = candidates[0]
+        if len(candidates) == 1:
+            best = [self._best_for_token(token) for token in tokens]
+            return self.docs[self._first_id(best)]
+        
+        # Most selective prefix first; each set & only walks the smaller side
+        ids = set().union(*(self.tokens[token] for token in tokens))
+        for _, _, tokens in candidates[1:]:
+            ids = set().union(*(ids & self.tokens[token] for token in tokens))
+            if not ids:
+                return None
+        return self.docs[self._first_id(ids)]
+    
+    def find_fuzzy(self, term: str, min_score: float) -> Optional[FoodMatch]:
+        """Best trigram-similarity match at or above min_score (misspellings, inflections)"""
+        query = food_trigrams(fold_food_name(term))
+        postings = sorted((self.trigrams[t] for t in query if t in self.trigrams), key=len)
+        if not postings:
+            return None
+        
+        # Count shared trigrams from the rarest postings; common ones like " ko"
+        # would touch most of the catalog and barely separate candidates
+        hits = Counter()
+        budget = max(len(postings[0]), FOOD_FUZZY_POSTINGS_BUDGET)
+        for ids in postings:
+            if budget < len(ids):
+                break
+            budget -= len(ids)
+            hits.update(ids)
+        
+        best, best_rank = None, None
+        for doc_id in heapq.nlargest(FOOD_FUZZY_CANDIDATES, hits, key=hits.get):
+            score = trigram_similarity(query, food_trigrams(self.keys[doc_id]))
+            rank = (-score, len(self.keys[doc_id]), self.order[doc_id])
+            if best_rank is None or rank < best_rank:
+                best, best_rank = doc_id, rank
+        score = -best_rank[0]
+        return FoodMatch(self.docs[best], "fuzzy", round(score, 3)) if score >= min_score else None
+
+food_index: Optional[FoodNameIndex] = None
+
+async def load_food_index():
+    """(Re)build the foods index off the event loop and swap it in"""
+    global food_index
+    docs = await db.foods.find({}).to_list(None)
+    loop = asyncio.get_running_loop()
+    food_index = await loop.run_in_executor(None, FoodNameIndex.build, docs)
+    logger.info(f"Food index loaded: {food_index.size} foods")
+
+async def refresh_food_index():
+    """Apply catalog changes incrementally by diffing against the current index"""
+    if food_index is None:
+        await load_food_index()
+        return
+    seen = set()
+    async for doc in db.foods.find({}):
+        seen.add(str(doc["_id"]))
+        food_index.upsert(doc)
+    for doc_id in [doc_id for doc_id in food_index.docs if doc_id not in seen]:
+        food_index.remove(doc_id)
+
+async def watch_food_catalog():
+    """Follow foods changes via a change stream, or poll where that is unsupported"""
+    try:
+        while True:
+            # Stream opened before the load so changes made during it are replayed.
+            # drop/rename/invalidate end the stream: reload and watch again.
+            async with db.foods.watch(full_document="updateLookup") as stream:
+                await load_food_index()
+                async for change in stream:
+                    if change["operationType"] == "delete":
+                        food_index.remove(str(change["documentKey"]["_id"]))
+                    elif change.get("fullDocument"):
+                        food_index.upsert(change["fullDocument"])
+            logger.info("Food catalog change stream ended, reloading the food index")
+    except Exception as e:
+        # Standalone mongod (change streams need a replica set) or a dropped stream
+        logger.info(f"Food catalog change stream unavailable ({e}), polling every {FOOD_INDEX_REFRESH_SECONDS}s")
+        if food_index is not None:
+            await asyncio.sleep(FOOD_INDEX_REFRESH_SECONDS)
+        # The first refresh loads the index if the stream never got that far
+        await run_periodic("food_index_refresh", FOOD_INDEX_REFRESH_SECONDS, refresh_food_index)
+
+def matched_food(food: Optional[Dict], match_type: str, term: str) -> Optional[FoodMatch]:
+    if not food:
+        return None
+    if match_type == "exact":
+        return FoodMatch(food, match_type, 1.0)
+    score = trigram_similarity(
+        food_trigrams(fold_food_name(term)), food_trigrams(fold_food_name(food.get("name", "")))
+    )
+    return FoodMatch(food, match_type, round(score, 3))
+
+async def map_foods_to_db(items: List[Dict[str, Any]], locale: str) -> List[Optional[FoodMatch]]:
+    """Map detected items (label + aliases) to the nutrition database.
+    
+    Per item, terms are tried label first, then aliases, each exact before partial,
+    which is the order of the former per-term find_one queries. Served from the
+    in-memory food index once loaded, otherwise from one $facet round trip. With
+    the index, items still unmatched get the best fuzzy match over all their
+    terms if it scores at least FOOD_MATCH_MIN_SCORE.
+    """
+    search_terms = [
+        [term for term in [item.get("label", "")] + item.get("aliases", []) if term]
+        for item in items
+    ]
+    if food_index is not None:
+        index = food_index
+        foods = []
+        for terms in search_terms:
+            match = None
+            for term in terms:
+                match = (
+                    matched_food(index.find_exact(term), "exact", term)
+                    or matched_food(index.find_partial(term), "partial", term)
+                )
+                if match:
+                    break
+            if not match:
+                fuzzy = [index.find_fuzzy(term, FOOD_MATCH_MIN_SCORE) for term in terms]
+                match = max((m for m in fuzzy if m), key=lambda m: m.score, default=None)
+            foods.append(match)
+        return foods
+    
+    term_ids = {term: i for i, term in enumerate(dict.fromkeys(
+        term for terms in search_terms for term in terms
+    ))}
+    if not term_ids:
+        return [None] * len(items)
+    
+    # One $facet branch per (term, exact/partial), each keeping the first match
+    facets = {}
+    for term, i in term_ids.items():
+        escaped = re.escape(term)
+        for kind, pattern in (("exact", f"^{escaped}$"), ("partial", escaped)):
+            facets[f"{kind}_{i}"] = [
+                {"$match": {"name": {"$regex": pattern, "$options": "i"}}},
+                {"$limit": 1},
+                {"$project": {"_id": 0}}
+            ]
+    
+    result = await db.foods.aggregate([{"$facet": facets}]).to_list(1)
+    matches = result[0] if result else {}
+    
+    def first_match(kind: str, term: str) -> Optional[Dict]:
+        docs = matches.get(f"{kind}_{term_ids[term]}")
+        return docs[0] if docs else None
+    
+    foods = []
+    for terms in search_terms:
+        match = None
+        for term in terms:
+            match = (
+                matched_food(first_match("exact", term), "exact", term)
+                or matched_food(first_match("partial", term), "partial", term)
+            )
+            if match:
+                break
+        foods.append(match)
+    return foods
+
+def detected_food_item(item_data: Dict[str, Any], match: Optional[FoodMatch]) -> DetectedFoodItem:
+    """One detected item with nutrition from its DB match, or a rough estimate"""
+    portion_g = item_data.get("portion", {}).get("estimate_g", 100)
+    db_food = match.food if match else None
+    
+    # Calculate nutrition from DB if found
+    if db_food:
+        # DB values are per 100g, scale by portion
+        scale = portion_g / 100.0
+        item_cal = int(db_food.get("calories", 0) * scale)
+        item_pro = round(db_food.get("protein", 0) * scale, 1)
+        item_carb = round(db_food.get("carbs", 0) * scale, 1)
+        item_fat = round(db_food.get("fat", 0) * scale, 1)
+        food_id = db_food.get("food_id")
+    else:
+        # Fallback: rough estimate (not from DB)
+        item_cal = int(portion_g * 1.5)  # ~150kcal per 100g average
+        item_pro = round(portion_g * 0.1, 1)
+        item_carb = round(portion_g * 0.2, 1)
+        item_fat = round(portion_g * 0.08, 1)
+        food_id = None
+    
+    return DetectedFoodItem(
+        label=item_data.get("label", "Bilinmeyen"),
+        aliases=item_data.get("aliases", []),
+        portion=PortionEstimate(
+            estimate_g=portion_g,
+            range_g=item_data.get("portion", {}).get("range_g", [int(portion_g*0.8), int(portion_g*1.2)]),
+            basis=item_data.get("portion", {}).get("basis", "visual_estimate")
+        ),
+        confidence=item_data.get("confidence", 0.7),
+        food_id=food_id,
+        match_type=match.match_type if match else None,
+        match_score=match.score if match else None,
+        calories=item_cal,
+        protein=item_pro,
+        carbs=item_carb,
+        fat=item_fat
     )
-    
-    return User(**user_doc)
 
-# ==================== USER ENDPOINTS ====================
+def vision_totals(items: List[DetectedFoodItem], detections: Dict[str, Any]) -> Dict[str, Any]:
+    """Everything in a VisionAnalyzeResponse except the items"""
+    needs_confirmation = detections.get("needs_user_confirmation")
+    return {
+        "notes": detections.get("notes", []),
+        "needs_user_confirmation": len(items) == 0 if needs_confirmation is None else needs_confirmation,
+        "total_calories": sum(item.calories for item in items),
+        "total_protein": round(sum(item.protein for item in items), 1),
+        "total_carbs": round(sum(item.carbs for item in items), 1),
+        "total_fat": round(sum(item.fat for item in items), 1),
+        # Detections cached before the cascade came from the fast model
+        "model_tier": detections.get("model_tier", "fast")
+    }
 
-@api_router.get("/user/profile", response_model=User)
-async def get_profile(current_user: Optional[User] = Depends(get_current_user)):
-    """Get user profile"""
-    if not current_user:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    return current_user
+async def build_vision_result(detections: Dict[str, Any], locale: str) -> Dict[str, Any]:
+    """Attach DB nutrition to detected items and total them up"""
+    detected = detections.get("items", [])
+    
+    # Map to nutrition DB
+    db_matches = await map_foods_to_db(detected, locale)
+    items = [detected_food_item(item_data, match) for item_data, match in zip(detected, db_matches)]
+    
+    return {"items": [item.dict() for item in items], **vision_totals(items, detections)}
 
-@api_router.put("/user/goals", response_model=User)
-async def update_goals(
-    goals: UpdateGoals,
+@api_router.post("/meal/vision", response_model=VisionAnalyzeResponse)
+async def analyze_meal_vision(
+    request_data: VisionAnalyzeRequest,
+    response: Response,
     current_user: Optional[User] = Depends(get_current_user)
 ):
-    """Update user goals"""
+    """
+    Analyze food image, cheapest model first
+    Stage 1: Detect foods + estimate portions with the fast tier
+    Stage 2 (optional): Re-analyze with the strong tier when stage 1 is unsure, within budget
+    """
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    update_data = goals.dict(exclude_none=True)
-    
-    await db.users.update_one(
-        {"user_id": current_user.user_id},
-        {"$set": update_data}
-    )
-    
-    user_doc = await db.users.find_one(
-        {"user_id": current_user.user_id},
-        {"_id": 0}
-    )
-    
-    return User(**user_doc)
-
-# ==================== FOOD ENDPOINTS ====================
+    image_bytes = decode_image_base64(request_data.image_base64)
+    return await run_meal_vision(image_bytes, request_data.locale, response, current_user)
 
-@api_router.post("/food/analyze", response_model=AnalyzeFoodResponse)
-async def analyze_food(
-    request_data: AnalyzeFoodRequest,
+@api_router.post("/meal/vision/upload", response_model=VisionAnalyzeResponse)
+async def analyze_meal_vision_upload(
+    response: Response,
+    image: UploadFile = File(...),
+    locale: str = Form("tr-TR"),
     current_user: Optional[User] = Depends(get_current_user)
 ):
-    """Analyze food image using GPT-4 Vision (Legacy endpoint)"""
+    """Multipart variant of /meal/vision: raw image bytes instead of base64 JSON"""
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
+    return await run_meal_vision(await read_upload_image(image), locale, response, current_user)
+
+async def run_meal_vision(
+    image_bytes: bytes,
+    locale: str,
+    response: Response,
+    current_user: User
+) -> VisionAnalyzeResponse:
+    set_llm_priority(current_user.is_premium)
     try:
-        # Create LLM chat instance
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"food_analysis_{current_user.user_id}_{datetime.now().timestamp()}",
-            system_message="You are a nutrition expert. Analyze food images and provide accurate calorie and macronutrient information."
-        ).with_model("openai", "gpt-4o")
-        
-        # Create image content
-        image_content = ImageContent(image_base64=request_data.image_base64)
-        
-        # Create message
-        message = UserMessage(
-            text="""Analyze this food image and provide:
-1. Total calories (kcal)
-2. Protein (grams)
-3. Carbohydrates (grams)
-4. Fat (grams)
-5. Brief description of the food
-
-Respond in this exact JSON format:
-{
-  "calories": <number>,
-  "protein": <number>,
-  "carbs": <number>,
-  "fat": <number>,
-  "description": "<text>"
-}""",
-            file_contents=[image_content]
+        trace = new_vision_trace()
+        detections = await get_vision_detections(
+            get_cache_key(image_bytes), image_bytes, trace, current_user.user_id
         )
+        result = await build_vision_result(detections, locale)
+        apply_vision_trace(response, trace)
         
-        # Get response
-        response = await chat.send_message(message)
-        
-        # Parse response
-        import json
-        response_text = response.strip()
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0].strip()
-        
-        data = json.loads(response_text)
-        
-        return AnalyzeFoodResponse(
-            calories=int(data["calories"]),
-            protein=float(data["protein"]),
-            carbs=float(data["carbs"]),
-            fat=float(data["fat"]),
-            description=data["description"]
-        )
+        logger.info(f"Vision analysis complete: {len(result['items'])} items detected ({trace['source']})")
+        return VisionAnalyzeResponse(**result)
     
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error analyzing food: {e}")
-        raise HTTPException(status_code=500, detail=f"Error analyzing food: {str(e)}")
+        logger.error(f"Error in vision analysis: {e}")
+        raise HTTPException(status_code=500, detail=f"Analiz hatası: {str(e)}")
 
-# Vision cache for cost optimization
-vision_cache: Dict[str, Any] = {}
-
-def get_cache_key(image_base64: str, user_id: str) -> str:
-    """Generate cache key from image hash"""
-    import hashlib
-    image_hash = hashlib.md5(image_base64[:1000].encode()).hexdigest()[:16]
-    date_str = datetime.now(timezone.utc).strftime("%Y%m%d")
-    return f"{user_id}_{date_str}_{image_hash}"
-
-async def map_food_to_db(label: str, aliases: List[str], locale: str) -> Optional[Dict]:
-    """Map detected food label to nutrition database"""
-    # Search in food database
-    search_terms = [label] + aliases
-    
-    for term in search_terms:
-        # Try exact match first
-        food = await db.foods.find_one(
-            {"name": {"$regex": f"^{term}$", "$options": "i"}},
-            {"_id": 0}
-        )
-        if food:
-            return food
+@api_router.post("/meal/vision/batch", response_model=VisionBatchResponse)
+async def analyze_meal_vision_batch(
+    request_data: VisionBatchRequest,
+    current_user: Optional[User] = Depends(get_current_user)
+):
+    """Analyze several photos of one meal: per-photo results plus merged meal totals"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    check_batch_size(len(request_data.images_base64))
+    return await run_meal_vision_batch(request_data.images_base64, request_data.locale, current_user)
+
+@api_router.post("/meal/vision/batch/upload", response_model=VisionBatchResponse)
+async def analyze_meal_vision_batch_upload(
+    images: List[UploadFile] = File(...),
+    locale: str = Form("tr-TR"),
+    current_user: Optional[User] = Depends(get_current_user)
+):
+    """Multipart variant of /meal/vision/batch"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    check_batch_size(len(images))
+    return await run_meal_vision_batch(images, locale, current_user)
+
+def check_batch_size(count: int):
+    if not 1 <= count <= VISION_BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"1-{VISION_BATCH_MAX_IMAGES} görsel gönderin")
+
+async def load_batch_image(image: Union[str, UploadFile]) -> bytes:
+    """Bytes of one batch entry, a base64 string or an upload"""
+    if isinstance(image, str):
+        return decode_image_base64(image)
+    return await read_upload_image(image)
+
+async def run_meal_vision_batch(
+    images: List[Union[str, UploadFile]],
+    locale: str,
+    current_user: User
+) -> VisionBatchResponse:
+    set_llm_priority(current_user.is_premium)
+    semaphore = asyncio.Semaphore(VISION_BATCH_CONCURRENCY)
+    
+    async def detect(image: Union[str, UploadFile]) -> Dict[str, Any]:
+        # Decoded here so an unreadable or oversized photo only fails its own result
+        image_bytes = await load_batch_image(image)
+        async with semaphore:
+            return await get_vision_detections(
+                get_cache_key(image_bytes), image_bytes, new_vision_trace(), current_user.user_id
+            )
+    
+    # A failed photo is reported in its own result, the rest of the batch goes on
+    outcomes = await asyncio.gather(*(detect(image) for image in images), return_exceptions=True)
+    
+    # One mapping pass for the items of every photo
+    detected = [outcome.get("items", []) if isinstance(outcome, dict) else [] for outcome in outcomes]
+    matches = await map_foods_to_db([item for items in detected for item in items], locale)
+    
+    results = []
+    groups: Dict[str, List[DetectedFoodItem]] = {}  # food -> its items in the most confident photo
+    notes: List[str] = []
+    position = 0
+    for index, (outcome, items_data) in enumerate(zip(outcomes, detected)):
+        if isinstance(outcome, BaseException):
+            status_code = outcome.status_code if isinstance(outcome, HTTPException) else 500
+            detail = outcome.detail if isinstance(outcome, HTTPException) else f"Analiz hatası: {str(outcome)}"
+            logger.error(f"Batch image {index} failed: {detail}")
+            results.append(VisionBatchImageResult(index=index, status="error", status_code=status_code, error=detail))
+            continue
         
-        # Try partial match
-        food = await db.foods.find_one(
-            {"name": {"$regex": term, "$options": "i"}},
-            {"_id": 0}
-        )
-        if food:
-            return food
+        image_matches = matches[position:position + len(items_data)]
+        position += len(items_data)
+        items = [detected_food_item(item_data, match) for item_data, match in zip(items_data, image_matches)]
+        results.append(VisionBatchImageResult(
+            index=index,
+            status="ok",
+            result=VisionAnalyzeResponse(items=items, **vision_totals(items, outcome))
+        ))
+        notes.extend(note for note in outcome.get("notes", []) if note not in notes)
+        
+        # Same dish from another angle: keep the photo that saw it most confidently.
+        # Repeats within one photo (two plates of rice) are separate portions.
+        per_food: Dict[str, List[DetectedFoodItem]] = {}
+        for item in items:
+            per_food.setdefault(item.food_id or fold_food_name(item.label), []).append(item)
+        for key, food_items in per_food.items():
+            best = groups.get(key)
+            if best is None or max(i.confidence for i in food_items) > max(i.confidence for i in best):
+                groups[key] = food_items
     
-    return None
+    failed = sum(result.status == "error" for result in results)
+    if failed == len(results):
+        first = results[0]
+        raise HTTPException(status_code=first.status_code, detail=first.error)
+    
+    merged = [item for food_items in groups.values() for item in food_items]
+    totals = vision_totals(merged, {"notes": notes, "needs_user_confirmation": any(
+        result.result.needs_user_confirmation for result in results if result.result
+    ) or failed > 0})
+    totals.pop("model_tier")
+    return VisionBatchResponse(results=results, items=merged, failed=failed, **totals)
 
-@api_router.post("/meal/vision", response_model=VisionAnalyzeResponse)
-async def analyze_meal_vision(
+@api_router.post("/meal/vision/stream")
+async def analyze_meal_vision_stream(
     request_data: VisionAnalyzeRequest,
     current_user: Optional[User] = Depends(get_current_user)
 ):
     """
-    Analyze food image using GPT-5-nano (cost-optimized)
-    Stage 1: Detect foods + estimate portions
-    Stage 2 (optional): Fallback to gpt-5 for accuracy
+    /meal/vision as server-sent events: an "item" event per DetectedFoodItem as soon as
+    the model has named it, then "totals" (the rest of VisionAnalyzeResponse).
+    "reset" means the strong tier re-analyzed the photo and its items follow;
+    "error" carries status_code and detail.
     """
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
+    image_bytes = decode_image_base64(request_data.image_base64)
+    return StreamingResponse(
+        stream_meal_vision(image_bytes, request_data.locale, current_user),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+async def stream_meal_vision(image_bytes: bytes, locale: str, current_user: User):
+    set_llm_priority(current_user.is_premium)
+    # Runs through the same single-flight as /meal/vision; only the caller that starts the
+    # model call receives items early, the others get the whole result once it is ready
+    items: asyncio.Queue = asyncio.Queue()
+    analysis = asyncio.ensure_future(get_vision_detections(
+        get_cache_key(image_bytes), image_bytes, new_vision_trace(), current_user.user_id, items
+    ))
+    analysis.add_done_callback(lambda _: items.put_nowait(None))
     try:
-        # Check cache
-        cache_key = get_cache_key(request_data.image_base64, current_user.user_id)
-        if cache_key in vision_cache:
-            logger.info(f"Cache hit for {cache_key}")
-            return VisionAnalyzeResponse(**vision_cache[cache_key])
-        
-        # Create LLM chat with gpt-5-nano (cost-optimized)
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"vision_{current_user.user_id}_{datetime.now().timestamp()}",
-            system_message="""Sen bir beslenme uzmanısın. Yemek fotoğraflarını analiz et.
-KURALLAR:
-- SADECE yemekleri tespit et ve porsiyon tahmini yap
-- Kalori/makro değerleri VERME (veritabanından alınacak)
-- Türk yemeklerini tanı
-- Emin değilsen birden fazla alternatif ver
-- JSON formatında yanıt ver"""
-        ).with_model("openai", "gpt-4o-mini")  # Cost optimized model
+        streamed = []
+        finished = False
+        while not finished:
+            # Map whatever the model has named so far in one lookup; items arriving during
+            # the lookup make up the next batch, so round trips stay few on a slow database
+            batch = [await items.get()]
+            while not items.empty():
+                batch.append(items.get_nowait())
+            if batch[-1] is None:
+                finished = True
+                batch.pop()
+            if not batch:
+                continue
+            for item_data, match in zip(batch, await map_foods_to_db(batch, locale)):
+                item = detected_food_item(item_data, match)
+                streamed.append(item)
+                yield sse_event("item", item.dict())
+        detections = analysis.result()
         
-        # Create image content
-        image_content = ImageContent(image_base64=request_data.image_base64)
+        if streamed:
+            if detections.get("model_tier", "fast") == "fast":
+                yield sse_event("totals", vision_totals(streamed, detections))
+                return
+            # The strong tier re-analyzed the photo, its items replace the streamed ones
+            yield sse_event("reset", {"model_tier": detections["model_tier"]})
         
-        # Vision prompt (minimal for cost)
-        prompt = """Bu yemek fotoğrafını analiz et.
+        result = await build_vision_result(detections, locale)
+        for item in result.pop("items"):
+            yield sse_event("item", item)
+        yield sse_event("totals", result)
+    
+    except HTTPException as e:
+        yield sse_event("error", {"status_code": e.status_code, "detail": e.detail})
+    except Exception as e:
+        logger.error(f"Error in streaming vision analysis: {e}")
+        yield sse_event("error", {"status_code": 500, "detail": f"Analiz hatası: {str(e)}"})
+    finally:
+        # Client gone: leave the analysis to any other waiters, or let the single-flight drop it
+        analysis.cancel()
 
-JSON formatında yanıt ver:
-{
-  "items": [
-    {
-      "label": "yemek adı",
-      "aliases": ["alternatif isim"],
-      "portion": {
-        "estimate_g": 180,
-        "range_g": [140, 240],
-        "basis": "visual_estimate"
-      },
-      "confidence": 0.85
-    }
-  ],
-  "notes": ["not varsa"],
-  "needs_user_confirmation": false
+# Asynchronous vision jobs: submit returns at once, a worker pool runs the same
+# pipeline and clients poll (or long-poll) for the result. Jobs live in
+# vision_jobs so queued and in-flight work survives a restart; available_at is
+# when a queued job may start or when a running job's lease runs out.
+vision_job_waiters: Dict[str, List[asyncio.Event]] = {}  # job -> one event per waiting poll
+vision_job_wakeup = asyncio.Event()
+vision_job_wait_latency = LatencyRecorder()
+vision_job_run_latency = LatencyRecorder()
+vision_job_stats: Dict[str, int] = {
+    "submitted": 0,
+    "completed": 0,
+    "failed": 0,
+    "retried": 0,
+    "running": 0,
 }
 
-Sadece JSON yanıt ver, başka açıklama yapma."""
-        
-        message = UserMessage(
-            text=prompt,
-            file_contents=[image_content]
-        )
-        
-        # Get response
-        response = await chat.send_message(message)
-        
-        # Parse response
-        import json
-        response_text = response.strip()
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0].strip()
-        
-        # Clean up response
-        response_text = response_text.replace('\n', '').replace('\r', '')
+def vision_job_view(job: Dict[str, Any]) -> VisionJobResponse:
+    error = job.get("error")
+    return VisionJobResponse(
+        job_id=job["_id"],
+        status=job["status"],
+        created_at=job["created_at"],
+        started_at=job.get("started_at"),
+        finished_at=job.get("finished_at"),
+        result=job.get("result"),
+        error=error["detail"] if error else None
+    )
+
+async def submit_vision_job(image_bytes: bytes, locale: str, current_user: User) -> VisionJobResponse:
+    now = datetime.now(timezone.utc)
+    job = {
+        "_id": f"vjob_{uuid.uuid4().hex}",
+        "user_id": current_user.user_id,
+        "is_premium": bool(current_user.is_premium),
+        "status": "queued",
+        "image": image_bytes,
+        "locale": locale,
+        "attempts": 0,
+        "created_at": now,
+        "available_at": now,
+        "expires_at": now + timedelta(hours=VISION_JOB_TTL_HOURS)
+    }
+    await db.vision_jobs.insert_one(job)
+    vision_job_stats["submitted"] += 1
+    vision_job_wakeup.set()
+    return vision_job_view(job)
+
+@api_router.post("/meal/vision/jobs", response_model=VisionJobResponse, status_code=202)
+async def create_vision_job(
+    request_data: VisionAnalyzeRequest,
+    current_user: Optional[User] = Depends(get_current_user)
+):
+    """Queue a /meal/vision analysis, poll GET /meal/vision/jobs/{job_id} for the result"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    image_bytes = decode_image_base64(request_data.image_base64)
+    return await submit_vision_job(image_bytes, request_data.locale, current_user)
+
+@api_router.post("/meal/vision/jobs/upload", response_model=VisionJobResponse, status_code=202)
+async def create_vision_job_upload(
+    image: UploadFile = File(...),
+    locale: str = Form("tr-TR"),
+    current_user: Optional[User] = Depends(get_current_user)
+):
+    """Multipart variant of POST /meal/vision/jobs"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    return await submit_vision_job(await read_upload_image(image), locale, current_user)
+
+@api_router.get("/meal/vision/jobs/{job_id}", response_model=VisionJobResponse)
+async def get_vision_job(
+    job_id: str,
+    wait: float = 0,
+    current_user: Optional[User] = Depends(get_current_user)
+):
+    """Job status; with wait=N seconds, hold the request until the job finishes or N passes"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(max(wait, 0), VISION_JOB_MAX_WAIT_SECONDS)
+    projection = {"image": 0}
+    while True:
+        job = await db.vision_jobs.find_one({"_id": job_id, "user_id": current_user.user_id}, projection)
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        remaining = deadline - loop.time()
+        if job["status"] in ("done", "failed") or remaining <= 0:
+            return vision_job_view(job)
         
+        # Woken by a local worker at once; jobs run by other workers are re-read every second
+        event = asyncio.Event()
+        waiters = vision_job_waiters.setdefault(job_id, [])
+        waiters.append(event)
         try:
-            data = json.loads(response_text)
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON parse error: {e}, response: {response_text[:200]}")
-            # Retry with fix instruction
-            raise HTTPException(status_code=500, detail="AI yanıt formatı hatalı, tekrar deneyin")
-        
-        items = []
-        total_cal = 0
-        total_pro = 0
-        total_carb = 0
-        total_fat = 0
-        
-        for item_data in data.get("items", []):
-            # Map to nutrition DB
-            db_food = await map_food_to_db(
-                item_data.get("label", ""),
-                item_data.get("aliases", []),
-                request_data.locale
+            await asyncio.wait_for(event.wait(), min(1.0, remaining))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiters.remove(event)
+            if not waiters and vision_job_waiters.get(job_id) is waiters:
+                del vision_job_waiters[job_id]
+
+async def claim_vision_job() -> Optional[Dict[str, Any]]:
+    now = datetime.now(timezone.utc)
+    return await db.vision_jobs.find_one_and_update(
+        {"status": {"$in": ["queued", "running"]}, "available_at": {"$lte": now}},
+        {
+            "$set": {
+                "status": "running",
+                "worker_id": WORKER_ID,
+                "started_at": now,
+                "available_at": now + timedelta(seconds=VISION_JOB_LEASE_SECONDS)
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("available_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def finish_vision_job(job: Dict[str, Any], update: Dict[str, Any]):
+    # Conditional on our lease: a job taken over after an expired lease is not ours to finish
+    await db.vision_jobs.update_one(
+        {"_id": job["_id"], "worker_id": WORKER_ID, "attempts": job["attempts"]},
+        update
+    )
+    for event in vision_job_waiters.get(job["_id"], []):
+        event.set()
+
+async def renew_vision_job_lease(job: Dict[str, Any]):
+    """Keep pushing out the lease of a job this worker is running, so a long run (cascade,
+    retries, admission queueing) is never reclaimed and run twice by another worker"""
+    while True:
+        await asyncio.sleep(VISION_JOB_LEASE_SECONDS / 3)
+        try:
+            renewed = await db.vision_jobs.update_one(
+                {"_id": job["_id"], "worker_id": WORKER_ID, "attempts": job["attempts"], "status": "running"},
+                {"$set": {"available_at": datetime.now(timezone.utc) + timedelta(seconds=VISION_JOB_LEASE_SECONDS)}}
             )
-            
-            portion_g = item_data.get("portion", {}).get("estimate_g", 100)
-            
-            # Calculate nutrition from DB if found
-            if db_food:
-                # DB values are per 100g, scale by portion
-                scale = portion_g / 100.0
-                item_cal = int(db_food.get("calories", 0) * scale)
-                item_pro = round(db_food.get("protein", 0) * scale, 1)
-                item_carb = round(db_food.get("carbs", 0) * scale, 1)
-                item_fat = round(db_food.get("fat", 0) * scale, 1)
-                food_id = db_food.get("food_id")
-            else:
-                # Fallback: rough estimate (not from DB)
-                item_cal = int(portion_g * 1.5)  # ~150kcal per 100g average
-                item_pro = round(portion_g * 0.1, 1)
-                item_carb = round(portion_g * 0.2, 1)
-                item_fat = round(portion_g * 0.08, 1)
-                food_id = None
-            
-            items.append(DetectedFoodItem(
-                label=item_data.get("label", "Bilinmeyen"),
-                aliases=item_data.get("aliases", []),
-                portion=PortionEstimate(
-                    estimate_g=portion_g,
-                    range_g=item_data.get("portion", {}).get("range_g", [int(portion_g*0.8), int(portion_g*1.2)]),
-                    basis=item_data.get("portion", {}).get("basis", "visual_estimate")
-                ),
-                confidence=item_data.get("confidence", 0.7),
-                food_id=food_id,
-                calories=item_cal,
-                protein=item_pro,
-                carbs=item_carb,
-                fat=item_fat
-            ))
-            
-            total_cal += item_cal
-            total_pro += item_pro
-            total_carb += item_carb
-            total_fat += item_fat
-        
-        result = {
-            "items": [item.dict() for item in items],
-            "notes": data.get("notes", []),
-            "needs_user_confirmation": data.get("needs_user_confirmation", len(items) == 0),
-            "total_calories": total_cal,
-            "total_protein": round(total_pro, 1),
-            "total_carbs": round(total_carb, 1),
-            "total_fat": round(total_fat, 1)
-        }
-        
-        # Cache result
-        vision_cache[cache_key] = result
-        
-        logger.info(f"Vision analysis complete: {len(items)} items detected")
-        return VisionAnalyzeResponse(**result)
+        except Exception as e:
+            logger.warning(f"Vision job {job['_id']} lease renewal failed: {e}")
+            continue
+        if renewed.matched_count == 0:
+            return  # finished, handed back or no longer ours
+
+async def run_vision_job(job: Dict[str, Any]):
+    now = datetime.now(timezone.utc)
+    if job["attempts"] == 1:
+        vision_job_wait_latency.record((now - job["created_at"].replace(tzinfo=timezone.utc)).total_seconds())
     
-    except HTTPException:
+    if job["attempts"] > VISION_JOB_MAX_ATTEMPTS:
+        vision_job_stats["failed"] += 1
+        await finish_vision_job(job, {
+            "$set": {"status": "failed", "finished_at": now, "error": {"status_code": 500, "detail": "Analiz tamamlanamadı"}},
+            "$unset": {"image": ""}
+        })
+        return
+    
+    started = time.perf_counter()
+    set_llm_priority(job.get("is_premium", False))
+    try:
+        image_bytes = job["image"]
+        detections = await get_vision_detections(
+            get_cache_key(image_bytes), image_bytes, new_vision_trace(), job["user_id"]
+        )
+        result = VisionAnalyzeResponse(**await build_vision_result(detections, job["locale"]))
+    except asyncio.CancelledError:
+        # Shutting down: hand the job back instead of waiting out the lease
+        await db.vision_jobs.update_one(
+            {"_id": job["_id"], "worker_id": WORKER_ID, "attempts": job["attempts"]},
+            {"$set": {"status": "queued", "available_at": datetime.now(timezone.utc)}, "$inc": {"attempts": -1}}
+        )
         raise
     except Exception as e:
-        logger.error(f"Error in vision analysis: {e}")
-        raise HTTPException(status_code=500, detail=f"Analiz hatası: {str(e)}")
+        vision_job_run_latency.record_error()
+        status_code = e.status_code if isinstance(e, HTTPException) else 500
+        detail = e.detail if isinstance(e, HTTPException) else f"Analiz hatası: {str(e)}"
+        if status_code in (429, 503) and job["attempts"] < VISION_JOB_MAX_ATTEMPTS:
+            # Provider unavailable or LLM calls saturated: try again later rather than failing the job
+            vision_job_stats["retried"] += 1
+            retry_after = float((e.headers or {}).get("Retry-After", 5))
+            await finish_vision_job(job, {"$set": {
+                "status": "queued",
+                "available_at": datetime.now(timezone.utc) + timedelta(seconds=retry_after)
+            }})
+            return
+        logger.error(f"Vision job {job['_id']} failed: {detail}")
+        vision_job_stats["failed"] += 1
+        await finish_vision_job(job, {
+            "$set": {
+                "status": "failed",
+                "finished_at": datetime.now(timezone.utc),
+                "error": {"status_code": status_code, "detail": detail}
+            },
+            "$unset": {"image": ""}
+        })
+        return
+    
+    vision_job_run_latency.record(time.perf_counter() - started)
+    vision_job_stats["completed"] += 1
+    await finish_vision_job(job, {
+        "$set": {"status": "done", "finished_at": datetime.now(timezone.utc), "result": result.dict()},
+        "$unset": {"image": ""}
+    })
+
+async def run_vision_job_worker():
+    """One slot of the job pool: claim, run, repeat; idle until woken or the poll interval"""
+    while True:
+        try:
+            job = await claim_vision_job()
+        except Exception as e:
+            logger.error(f"Vision job claim failed: {e}")
+            job = None
+        if job is None:
+            vision_job_wakeup.clear()
+            try:
+                await asyncio.wait_for(vision_job_wakeup.wait(), VISION_JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        vision_job_stats["running"] += 1
+        renewal = asyncio.create_task(renew_vision_job_lease(job))
+        try:
+            await run_vision_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Vision job {job['_id']} crashed: {e}")
+        finally:
+            renewal.cancel()
+            vision_job_stats["running"] -= 1
 
 @api_router.post("/food/add-meal", response_model=Meal)
 async def add_meal(
@@ -907,6 +3500,44 @@ async def add_meal(
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
+    return await insert_meal(meal_data, current_user)
+
+@api_router.post("/food/add-meal/upload", response_model=Meal)
+async def add_meal_upload(
+    name: str = Form(...),
+    calories: int = Form(...),
+    protein: float = Form(...),
+    carbs: float = Form(...),
+    fat: float = Form(...),
+    meal_type: str = Form(...),
+    image: UploadFile = File(...),
+    current_user: Optional[User] = Depends(get_current_user)
+):
+    """Multipart variant of /food/add-meal: raw image bytes instead of base64 JSON"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    image_bytes = await read_upload_image(image)
+    try:
+        meal_data = AddMealRequest(
+            name=name,
+            calories=calories,
+            protein=protein,
+            carbs=carbs,
+            fat=fat,
+            meal_type=meal_type,
+            # meals keep storing base64 so existing clients can read them
+            image_base64=base64.b64encode(image_bytes).decode()
+        )
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=422,
+            detail=[{"loc": error["loc"], "msg": error["msg"]} for error in e.errors()]
+        )
+    
+    return await insert_meal(meal_data, current_user)
+
+async def insert_meal(meal_data: AddMealRequest, current_user: User) -> Meal:
     meal_id = f"meal_{uuid.uuid4().hex[:12]}"
     meal = {
         "meal_id": meal_id,
@@ -1397,6 +4028,7 @@ async def activate_premium(
             "premium_expires_at": expires_at
         }}
     )
+    await sync_user_sessions(current_user.user_id)
     
     return {
         "message": "Premium activated successfully",
@@ -1431,6 +4063,7 @@ async def watch_ad(
                 "ads_watched": new_ad_count
             }}
         )
+        await sync_user_sessions(current_user.user_id)
         
         return {
             "message": "Congratulations! You've earned 24 hours of premium",
@@ -1445,6 +4078,7 @@ async def watch_ad(
             {"user_id": current_user.user_id},
             {"$set": {"ads_watched": new_ad_count}}
         )
+        await sync_user_sessions(current_user.user_id)
         
         ads_remaining = ads_for_premium - (new_ad_count % ads_for_premium)
         
@@ -1477,15 +4111,327 @@ async def get_premium_status(current_user: Optional[User] = Depends(get_current_
                 {"user_id": current_user.user_id},
                 {"$set": {"is_premium": False}}
             )
+            await sync_user_sessions(current_user.user_id)
     
     return {
         "is_premium": is_premium,
         "premium_expires_at": premium_expires_at.isoformat() if premium_expires_at else None
     }
 
+# ==================== SYSTEM ====================
+
+def require_metrics_token(request: Request):
+    """Internal callers only: 404 unless METRICS_TOKEN is set, 403 without it"""
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = request.headers.get("X-Metrics-Token", "")
+    if not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+@api_router.get("/system/metrics", dependencies=[Depends(require_metrics_token)])
+async def get_system_metrics():
+    """In-process cache and performance counters of this worker"""
+    queued = await db.vision_jobs.count_documents({"status": "queued"})
+    return {
+        "session_cache": session_cache.stats(),
+        "session_resolution_mode": SESSION_RESOLUTION_MODE,
+        "guest_reaper": guest_reaper_stats,
+        "auth_exchange": auth_exchange_latency.stats(),
+        "revoked_tokens": len(revoked_token_ids),
+        "vision_cache": vision_cache.stats(),
+        "vision": vision_stats,
+        "phash_index_size": phash_index.size,
+        "phash_index_evictions": phash_index.evictions,
+        "vision_jobs": {
+            **vision_job_stats,
+            "queue_depth": queued,
+            "workers": VISION_JOB_WORKERS,
+            "queue_wait": vision_job_wait_latency.stats(),
+            "run_time": vision_job_run_latency.stats(),
+        },
+        "vision_cascade": {
+            **vision_escalation_stats,
+            "escalation_rate": round(
+                vision_escalation_stats["escalations"] / max(1, vision_escalation_stats["analyses"]), 4
+            ),
+            "tiers": {
+                tier: {
+                    **stats,
+                    "estimated_cost_usd": round(stats["estimated_cost_usd"], 4),
+                    "latency": stats["latency"].stats()
+                }
+                for tier, stats in vision_tier_stats.items()
+            },
+        },
+        "json_extract": json_extract_stats,
+        "llm_admission": llm_admission.stats(),
+        "llm": {
+            "provider": LLM_PROVIDER,
+            **llm_stats,
+            "latency": llm_latency.stats(),
+            "breakers": {model[1]: breaker.stats() for model, breaker in llm_breakers.items()},
+        },
+        "food_index_size": food_index.size if food_index is not None else None,
+        "vision_single_flight": vision_flights.stats(),
+        "image_preprocess": {
+            **preprocess_stats,
+            "stages": {stage: recorder.stats() for stage, recorder in preprocess_latency.items()}
+        }
+    }
+
+# ==================== DATABASE INDEXES ====================
+
+# Indexes backing every hot query shape; created idempotently at startup
+DB_INDEXES: Dict[str, List[IndexModel]] = {
+    "user_sessions": [
+        IndexModel([("session_token", ASCENDING)], unique=True, name="session_token_unique"),
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+        # MongoDB deletes sessions once expires_at has passed
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+    "revoked_tokens": [
+        IndexModel([("jti", ASCENDING)], unique=True, name="jti_unique"),
+        IndexModel([("revoked_at", ASCENDING)], name="revoked_at"),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+    "vision_results": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+    ],
+    "vision_jobs": [
+        IndexModel([("status", ASCENDING), ("available_at", ASCENDING)], name="status_available_at"),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+    "escalation_budgets": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+    "users": [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+        IndexModel([("email", ASCENDING)], unique=True, name="email_unique"),
+        IndexModel([("auth_type", ASCENDING), ("user_id", ASCENDING)], name="auth_type_user_id"),
+    ],
+    "meals": [
+        IndexModel([("user_id", ASCENDING), ("timestamp", ASCENDING)], name="user_id_timestamp"),
+    ],
+    "water_logs": [
+        IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], name="user_id_date"),
+    ],
+    "step_logs": [
+        IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], name="user_id_date"),
+    ],
+    "user_vitamins": [
+        IndexModel([("user_id", ASCENDING), ("vitamin_id", ASCENDING)], name="user_id_vitamin_id"),
+    ],
+    "user_diets": [
+        IndexModel([("user_id", ASCENDING), ("is_active", ASCENDING)], name="user_id_is_active"),
+        IndexModel([("user_diet_id", ASCENDING)], name="user_diet_id"),
+    ],
+    "diet_plans": [
+        IndexModel([("is_premium", ASCENDING)], name="is_premium"),
+    ],
+}
+
+# (collection, filter, sort) for each query the API runs per request
+HOT_QUERY_SHAPES = [
+    ("user_sessions", {"session_token": "sess_x"}, None),
+    ("users", {"user_id": "user_x"}, None),
+    ("users", {"email": "x@example.com"}, None),
+    ("meals", {"user_id": "user_x", "timestamp": {"$gte": datetime(2024, 1, 1), "$lt": datetime(2024, 1, 2)}}, [("timestamp", ASCENDING)]),
+    ("water_logs", {"user_id": "user_x", "date": "2024-01-01"}, None),
+    ("water_logs", {"user_id": "user_x", "date": {"$in": ["2024-01-01", "2024-01-02"]}}, None),
+    ("step_logs", {"user_id": "user_x", "date": "2024-01-01"}, None),
+    ("user_vitamins", {"user_id": "user_x"}, None),
+    ("user_vitamins", {"vitamin_id": "vit_x", "user_id": "user_x"}, None),
+    ("user_diets", {"user_id": "user_x"}, None),
+    ("user_diets", {"user_id": "user_x", "is_active": True}, None),
+    ("user_diets", {"user_diet_id": "diet_x", "user_id": "user_x"}, None),
+    ("diet_plans", {"is_premium": True}, None),
+    ("vision_jobs", {"status": {"$in": ["queued", "running"]}, "available_at": {"$lte": datetime(2024, 1, 1)}}, [("available_at", ASCENDING)]),
+]
+
+async def ensure_indexes():
+    """Create DB_INDEXES; safe to run on every start"""
+    for collection, indexes in DB_INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            # e.g. duplicate emails in legacy data block a unique index
+            logger.error(f"Could not create indexes on {collection}: {e}")
+
+def plan_stages(plan: Any) -> List[str]:
+    """Flatten every stage name found in an explain() plan tree"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+async def check_query_plans() -> List[Dict[str, Any]]:
+    """Run explain() on each hot query shape and report the winning plan stages.
+    An empty plan or a bare EOF (the collection does not exist yet) proves nothing
+    about index use, so such shapes are reported as not verified rather than ok."""
+    results = []
+    for collection, query, sort in HOT_QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        results.append({
+            "collection": collection,
+            "filter": list(query.keys()),
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+            "verified": bool(stages) and "EOF" not in stages
+        })
+    return results
+
+# ==================== BACKGROUND JOBS ====================
+
+# Collections holding per-user data, deleted before the users document itself
+USER_DATA_COLLECTIONS = ["meals", "water_logs", "step_logs", "user_vitamins", "user_diets", "user_sessions"]
+
+# Identifies this worker when holding job leases
+WORKER_ID = f"{os.uname().nodename}_{os.getpid()}_{uuid.uuid4().hex[:6]}"
+
+background_tasks: List[asyncio.Task] = []
+
+guest_reaper_stats: Dict[str, Any] = {
+    "runs": 0,
+    "guests_reaped": 0,
+    "last_run_at": None,
+    "last_duration_ms": None,
+}
+
+async def acquire_job_lease(name: str, ttl_seconds: float) -> bool:
+    """Take or extend a cross-worker lease so only one worker runs a periodic job"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.job_leases.update_one(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": WORKER_ID}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Lease exists and is held by another worker
+        return False
+
+async def delete_user_data(user_ids: List[str]):
+    """Delete users and everything they own"""
+    for collection in USER_DATA_COLLECTIONS:
+        await db[collection].delete_many({"user_id": {"$in": user_ids}})
+    await db.users.delete_many({"user_id": {"$in": user_ids}})
+    
+    user_id_set = set(user_ids)
+    session_cache.pop_where(lambda entry: entry.user.user_id in user_id_set)
+
+async def reap_guest_accounts() -> int:
+    """Delete abandoned guest accounts in batches, returns how many were removed"""
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=GUEST_RETENTION_DAYS)
+    last_user_id = ""
+    reaped = 0
+    
+    while True:
+        candidates = await db.users.find(
+            {"auth_type": "guest", "user_id": {"$gt": last_user_id}, "created_at": {"$lt": cutoff}},
+            {"_id": 0, "user_id": 1}
+        ).sort("user_id", ASCENDING).limit(GUEST_REAPER_BATCH_SIZE).to_list(GUEST_REAPER_BATCH_SIZE)
+        
+        if not candidates:
+            break
+        
+        user_ids = [candidate["user_id"] for candidate in candidates]
+        last_user_id = user_ids[-1]
+        
+        # A guest is abandoned once no live session can reach the account
+        active = set(await db.user_sessions.distinct(
+            "user_id",
+            {"user_id": {"$in": user_ids}, "expires_at": {"$gt": now}}
+        ))
+        abandoned = [user_id for user_id in user_ids if user_id not in active]
+        
+        if abandoned:
+            await delete_user_data(abandoned)
+            reaped += len(abandoned)
+        
+        if len(candidates) < GUEST_REAPER_BATCH_SIZE:
+            break
+        
+        # Leave room for request traffic between batches
+        await asyncio.sleep(GUEST_REAPER_BATCH_PAUSE_SECONDS)
+    
+    return reaped
+
+async def run_guest_reaper():
+    if not await acquire_job_lease("guest_reaper", GUEST_REAPER_INTERVAL_SECONDS * 2):
+        return
+    
+    started = time.monotonic()
+    reaped = await reap_guest_accounts()
+    
+    guest_reaper_stats["runs"] += 1
+    guest_reaper_stats["guests_reaped"] += reaped
+    guest_reaper_stats["last_run_at"] = datetime.now(timezone.utc).isoformat()
+    guest_reaper_stats["last_duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+    if reaped:
+        logger.info(f"Guest reaper removed {reaped} abandoned guest accounts")
+
+async def run_periodic(name: str, interval_seconds: float, job):
+    """Run job forever, every interval_seconds, logging failures instead of dying"""
+    while True:
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Background job {name} failed: {e}")
+        await asyncio.sleep(interval_seconds)
+
+@app.on_event("startup")
+async def create_db_indexes():
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def open_http_client():
+    get_http_client()
+
+@app.on_event("startup")
+async def start_background_jobs():
+    if SESSION_TOKEN_FORMAT == "signed" and not SESSION_SIGNING_KEY:
+        logger.warning("SESSION_TOKEN_FORMAT=signed without SESSION_SIGNING_KEY, issuing opaque tokens")
+    
+    background_tasks.append(asyncio.create_task(
+        run_periodic("guest_reaper", GUEST_REAPER_INTERVAL_SECONDS, run_guest_reaper)
+    ))
+    if SESSION_SIGNING_KEY:
+        background_tasks.append(asyncio.create_task(
+            run_periodic("revocation_sync", REVOCATION_SYNC_INTERVAL_SECONDS, sync_revoked_tokens)
+        ))
+    background_tasks.append(asyncio.create_task(
+        run_periodic("phash_index_sync", VISION_PHASH_SYNC_SECONDS, sync_phash_index)
+    ))
+    background_tasks.append(asyncio.create_task(watch_food_catalog()))
+    for _ in range(VISION_JOB_WORKERS):
+        background_tasks.append(asyncio.create_task(run_vision_job_worker()))
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(BodySizeLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -1497,3 +4443,28 @@ app.add_middleware(
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+    if http_client is not None:
+        await http_client.aclose()
+    password_executor.shutdown(wait=False)
+    image_executor.shutdown(wait=False)
+
+if __name__ == "__main__":
+    # python server.py check-indexes [--create]
+    import argparse
+    import sys
+    
+    parser = argparse.ArgumentParser(description="CalorieDiet backend admin commands")
+    parser.add_argument("command", choices=["check-indexes"])
+    parser.add_argument("--create", action="store_true", help="create missing indexes before checking")
+    args = parser.parse_args()
+    
+    async def run_index_check() -> int:
+        if args.create:
+            await ensure_indexes()
+        results = await check_query_plans()
+        for result in results:
+            status = "COLLSCAN" if result["collscan"] else "ok" if result["verified"] else "UNVERIFIED"
+            print(f"{status:<10} {result['collection']:<14} {result['filter']} -> {' > '.join(result['stages']) or '(no plan)'}")
+        return 1 if any(result["collscan"] or not result["verified"] for result in results) else 0
+    
+    sys.exit(asyncio.run(run_index_check()))
@@ -0,0 +1,55 @@
+"""
+POST /api/auth/session against an in-memory MongoDB with the production indexes
+and a mocked Emergent auth service.
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import httpx
+from mongomock_motor import AsyncMongoMockClient
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+import server  # noqa: E402
+
+UPSTREAM_SESSION = {
+    "id": "emergent_user_1",
+    "email": "ayse@example.com",
+    "name": "Ayşe",
+    "picture": None,
+    "session_token": "upstream_token_1",
+}
+
+
+def upstream_auth(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(200, json=UPSTREAM_SESSION)
+
+
+async def exchange_twice():
+    server.db = AsyncMongoMockClient()["test_database"]
+    await server.ensure_indexes()
+    server.http_client = httpx.AsyncClient(transport=httpx.MockTransport(upstream_auth))
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        responses = [
+            await client.post("/api/auth/session", headers={"X-Session-ID": "emergent_session"})
+            for _ in range(2)
+        ]
+    sessions = await server.db.user_sessions.find({}, {"_id": 0}).to_list(None)
+    await server.http_client.aclose()
+    return responses, sessions
+
+
+def test_exchanging_the_same_session_twice_reuses_it():
+    responses, sessions = asyncio.run(exchange_twice())
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert {response.json()["session_token"] for response in responses} == {"upstream_token_1"}
+    assert len(sessions) == 1
+    assert sessions[0]["user"]["email"] == "ayse@example.com"
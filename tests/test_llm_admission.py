@@ -0,0 +1,43 @@
+"""
+AdmissionController slot accounting when a queued caller gives up just as it is handed a slot.
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+def test_timeout_after_handover_returns_the_slot(monkeypatch):
+    controller = server.AdmissionController(limit=1, max_queue=4)
+
+    async def handed_over_then_timed_out(future, timeout):
+        # The holder finishes and hands its slot to this waiter in the same tick
+        # in which the waiter's deadline fires
+        controller.release(0.01)
+        assert future.done()
+        raise asyncio.TimeoutError
+
+    async def scenario():
+        await controller.acquire(server.LLM_PRIORITY_STANDARD, max_wait=5)
+        monkeypatch.setattr(server.asyncio, "wait_for", handed_over_then_timed_out)
+        with pytest.raises(server.HTTPException) as shed:
+            await controller.acquire(server.LLM_PRIORITY_STANDARD, max_wait=5)
+        monkeypatch.undo()
+
+        assert shed.value.status_code == 503
+        assert controller.active == 0
+        assert controller.stats()["queue_depth"] == 0
+        # Capacity is intact: the next caller is admitted at once
+        await asyncio.wait_for(controller.acquire(server.LLM_PRIORITY_STANDARD, max_wait=5), 1)
+        assert controller.active == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,42 @@
+"""
+Tolerant LLM reply extraction against the fixture corpus in tests/fixtures/llm_responses.json.
+
+Each fixture's expect says whether the reply must be recovered (ok) and, for
+detections, how many valid items must come out of it (items).
+"""
+
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+import server  # noqa: E402
+
+FIXTURES = json.loads((Path(__file__).parent / "fixtures" / "llm_responses.json").read_text(encoding="utf-8"))
+
+
+@pytest.mark.parametrize("case", FIXTURES, ids=[case["name"] for case in FIXTURES])
+def test_extracts_fixture_reply(case):
+    expect = case["expect"]
+    if not expect["ok"]:
+        with pytest.raises(server.LlmResponseFormatError):
+            data = server.extract_json_object(case["reply"])
+            if case["kind"] == "detections":
+                server.validate_detections(data)
+            else:
+                server.validate_food_analysis(data)
+        return
+
+    data = server.extract_json_object(case["reply"])
+    if case["kind"] == "detections":
+        detections = server.validate_detections(data)
+        if "items" in expect:
+            assert len(detections["items"]) == expect["items"]
+    else:
+        server.validate_food_analysis(data)
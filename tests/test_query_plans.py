@@ -0,0 +1,52 @@
+"""
+check_query_plans verdicts for the plans explain() can return.
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+import server  # noqa: E402
+
+PLANS = {
+    "ixscan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}},
+    "collscan": {"stage": "COLLSCAN"},
+    "missing_collection": {"stage": "EOF"},
+    "empty": {},
+}
+
+
+class ExplainCursor:
+    def __init__(self, plan):
+        self.plan = plan
+
+    def sort(self, sort):
+        return self
+
+    async def explain(self):
+        return {"queryPlanner": {"winningPlan": self.plan}}
+
+
+class ExplainCollection:
+    def __init__(self, plan):
+        self.plan = plan
+
+    def find(self, query):
+        return ExplainCursor(self.plan)
+
+
+def test_missing_or_empty_plans_are_not_verified(monkeypatch):
+    monkeypatch.setattr(server, "db", {name: ExplainCollection(plan) for name, plan in PLANS.items()})
+    monkeypatch.setattr(server, "HOT_QUERY_SHAPES", [(name, {"user_id": "u"}, None) for name in PLANS])
+
+    results = {result["collection"]: result for result in asyncio.run(server.check_query_plans())}
+
+    assert results["ixscan"]["verified"] and not results["ixscan"]["collscan"]
+    assert results["collscan"]["collscan"]
+    assert not results["missing_collection"]["verified"]
+    assert not results["empty"]["verified"]
@@ -0,0 +1,70 @@
+"""
+Vision job lease renewal and long-poll waiter bookkeeping against an in-memory MongoDB.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+from mongomock_motor import AsyncMongoMockClient
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+import server  # noqa: E402
+
+USER = server.User(
+    user_id="user_1",
+    email="ayse@example.com",
+    name="Ayşe",
+    created_at=datetime.now(timezone.utc),
+)
+
+
+async def queued_job() -> str:
+    server.db = AsyncMongoMockClient()["test_database"]
+    job = await server.submit_vision_job(b"jpeg", "tr", USER)
+    return job.job_id
+
+
+def test_lease_is_renewed_while_the_job_runs(monkeypatch):
+    monkeypatch.setattr(server, "VISION_JOB_LEASE_SECONDS", 0.3)
+
+    async def scenario():
+        await queued_job()
+        job = await server.claim_vision_job()
+        renewal = asyncio.create_task(server.renew_vision_job_lease(job))
+        await asyncio.sleep(0.5)
+        # Without renewal the 0.3s lease would have run out and the job be claimable again
+        assert await server.claim_vision_job() is None
+
+        await server.finish_vision_job(job, {"$set": {"status": "done", "result": {"items": []}}})
+        await asyncio.wait_for(renewal, 1)
+
+    asyncio.run(scenario())
+
+
+def test_polls_leave_no_waiters_behind():
+    async def scenario():
+        job_id = await queued_job()
+        view = await server.get_vision_job(job_id, wait=0.2, current_user=USER)
+        assert view.status == "queued"
+        assert server.vision_job_waiters == {}
+
+        job = await server.claim_vision_job()
+        polls = [
+            asyncio.create_task(server.get_vision_job(job_id, wait=5, current_user=USER))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0.05)
+        assert len(server.vision_job_waiters[job_id]) == 2
+        await server.finish_vision_job(job, {"$set": {"status": "done", "result": {"items": []}}})
+        views = await asyncio.wait_for(asyncio.gather(*polls), 1)
+
+        assert [view.status for view in views] == ["done", "done"]
+        assert server.vision_job_waiters == {}
+
+    asyncio.run(scenario())
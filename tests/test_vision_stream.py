@@ -0,0 +1,53 @@
+"""
+Database lookups made by the /meal/vision/stream event generator while items arrive.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+import server  # noqa: E402
+
+USER = server.User(
+    user_id="user_1",
+    email="ayse@example.com",
+    name="Ayşe",
+    created_at=datetime.now(timezone.utc),
+)
+
+DETECTED = [{"label": label, "portion": {"estimate_g": 150}} for label in ("pilav", "kuru fasulye", "cacık", "ayran")]
+
+
+def test_streamed_items_are_mapped_in_batches(monkeypatch):
+    lookups = []
+
+    async def detections(image_hash, image_bytes, trace, user_id, items):
+        # The model names two items, then the other two while the first lookup runs
+        for item_data in DETECTED[:2]:
+            items.put_nowait(item_data)
+        await asyncio.sleep(0.05)
+        for item_data in DETECTED[2:]:
+            items.put_nowait(item_data)
+        return {"items": DETECTED, "model_tier": "fast"}
+
+    async def map_foods_to_db(items, locale):
+        lookups.append([item["label"] for item in items])
+        await asyncio.sleep(0.1)
+        return [None] * len(items)
+
+    monkeypatch.setattr(server, "get_vision_detections", detections)
+    monkeypatch.setattr(server, "map_foods_to_db", map_foods_to_db)
+
+    async def collect():
+        return [event async for event in server.stream_meal_vision(b"jpeg", "tr-TR", USER)]
+
+    events = asyncio.run(collect())
+
+    assert [event.split("\n")[0] for event in events] == ["event: item"] * 4 + ["event: totals"]
+    assert lookups == [["pilav", "kuru fasulye"], ["cacık", "ayran"]]